@@ -0,0 +1,61 @@
+"""Tests of building shadows from stored memory maps."""
+
+import tarfile
+from pathlib import Path
+
+import pytest
+
+from tools.svdmap import make_shadows
+from tools.svdmap.model import Address, AddressSpan, MemoryMap, Shadow, Value
+from tools.svdmap.parallelization import Result
+from tools.svdmap.serstor import Storage
+
+
+def _memory_map(*offsets: int) -> MemoryMap:
+    """A memory map reading and writing one register at each offset."""
+    memory_map = MemoryMap()
+    for offset in offsets:
+        location = AddressSpan(Address(offset, 0), Address(4, 0))
+        memory_map.add_read(Value(location, 0, 0xFFFFFFFF))
+        memory_map.add_written(Value(location, 0, 0xFFFFFFFF))
+    return memory_map
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_rerun_over_per_device_cache(tmp_path: Path, binary: bool) -> None:
+    """Devices stored as aliases lose the rows an older run gave them."""
+    maps = {
+        "a.svd": _memory_map(0x40000000, 0x40000004),
+        "b.svd": _memory_map(0x40000000, 0x40000004),
+        "c.svd": _memory_map(0x50000000),
+    }
+    with Storage(tmp_path / "memory_maps") as storage:
+        for svd, memory_map in maps.items():
+            storage[svd] = Result[MemoryMap]([], {}, memory_map, None, [])
+
+    # an older run stored a shadow row for every device
+    with Storage(tmp_path / "shadow_maps") as old:
+        for svd, memory_map in maps.items():
+            words = {v.location.start.byte_offset for v in memory_map.read_values}
+            old[svd] = Shadow(name=svd, read=words, write=words)
+
+    output_dir = tmp_path / "shadows"
+    make_shadows(
+        tmp_path / "memory_maps",
+        tmp_path / "shadow_maps",
+        output_dir,
+        binary=binary,
+        jobs=1,
+    )
+
+    with Storage(tmp_path / "shadow_maps") as output:
+        assert sorted(output) == ["a.svd", "c.svd"]
+        shadow = output.get_and_unserialize("a.svd", Shadow)
+        assert shadow.aliases == ["b.svd"]
+    with tarfile.open(tmp_path / "shadow_maps.tar.gz") as tar:
+        assert sorted(tar.getnames()) == ["a.svd", "c.svd"]
+    assert sorted(p.name for p in output_dir.iterdir()) == [
+        "a.json",
+        "b.json",
+        "c.json",
+    ]
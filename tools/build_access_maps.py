@@ -1,16 +1,23 @@
 """Static analysis helper functions."""
 
+import argparse
+import hashlib
+from contextlib import ExitStack
+from functools import partial
 from pathlib import Path
 from shutil import move
-import sys
 from tempfile import TemporaryDirectory
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING, Self, cast
 from typing_extensions import TypeIs
 from urllib.request import urlretrieve
 from zipfile import ZipFile
 
 from pydantic import BaseModel, field_serializer, field_validator
-import pyghidra
+
+from svdmap import instrumentation, wordsets
+from svdmap.instrumentation import stage
+from svdmap.parallelization import Failure, isolated_map
+from svdmap.serstor import Storage
 
 
 def is_set_of_ints(value: object) -> TypeIs[set[int]]:
@@ -29,6 +36,8 @@ def is_list_of_strs(value: object) -> TypeIs[list[str]]:
 
 if TYPE_CHECKING:
     from ghidra.program.flatapi import FlatProgramAPI
+    from ghidra.program.model.listing import Program
+    from ghidra.util.task import TaskMonitor
 
 
 GHIDRA_URL = (
@@ -53,10 +62,14 @@ def install_ghidra(install_dir: Path) -> None:
 
 
 class AnalysisResult(BaseModel):
-    """Serializable result of an analysis."""
+    """
+    Serializable result of an analysis. Truncated results come from an
+    analysis that ran out of time and may miss accesses.
+    """
 
     read: set[int]
     write: set[int]
+    truncated: bool = False
 
     @field_serializer("read", "write")
     def serialize_read(self, value: list[int]) -> list[str]:
@@ -76,9 +89,100 @@ class AnalysisResult(BaseModel):
 
         raise ValueError("Unexpected type.")
 
+    def to_bytes(self) -> bytes:
+        """Serialize into a compact word set frame."""
+        return wordsets.encode(
+            [self.read, self.write], {"truncated": True} if self.truncated else None
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Self:
+        """Unserialize from a word set frame."""
+        meta, (read, write) = wordsets.decode(data)
+        return cls.model_construct(
+            read=set(read.tolist()),
+            write=set(write.tolist()),
+            truncated=isinstance(meta, dict) and meta.get("truncated") is True,
+        )
+
+
+# suffix of access map files in each format
+ACCESS_MAP_SUFFIXES = {"json": ".json", "binary": ".amap"}
+
+
+def load_access_map(path: Path) -> AnalysisResult:
+    """Read an access map file in either format."""
+    data = path.read_bytes()
+    if wordsets.is_frame(data):
+        return AnalysisResult.from_bytes(data)
+    return AnalysisResult.model_validate_json(data)
+
+
+def dump_access_map(result: AnalysisResult, path: Path) -> None:
+    """Write an access map file, in binary if it has the binary suffix."""
+    if path.suffix == ACCESS_MAP_SUFFIXES["binary"]:
+        path.write_bytes(result.to_bytes())
+    else:
+        path.write_text(result.model_dump_json(exclude_defaults=True))
+
+
+# Analyzers enabled by each profile, None keeps Ghidra's defaults. The
+# "refs-only" profile finds code and propagates constants into references, but
+# skips everything concerned with types, function signatures and decompiling.
+PROFILES: dict[str, frozenset[str] | None] = {
+    "full": None,
+    "refs-only": frozenset(
+        {
+            "ARM Constant Reference Analyzer",
+            "Create Address Tables",
+            "Data Reference",
+            "Disassemble Entry Points",
+            "Function Start Search",
+            "Function Start Search After Code",
+            "Function Start Search After Data",
+            "Non-Returning Functions - Discovered",
+            "Shared Return Calls",
+            "Subroutine References",
+        }
+    ),
+}
+
+
+def configure_analyzers(program: "Program", profile: str) -> None:
+    """Enable the analyzers of a profile and disable all others."""
+
+    enabled = PROFILES[profile]
+    if enabled is None:
+        return
+
+    from ghidra.framework.options import (  # pylint: disable=import-outside-toplevel
+        OptionType,
+    )
+
+    options = program.getOptions(program.ANALYSIS_PROPERTIES)
+    for name in options.getOptionNames():
+        # analyzers are toggled by top level boolean options
+        if "." not in name and options.getType(name) == OptionType.BOOLEAN_TYPE:
+            options.setBoolean(name, name in enabled)
 
-def analyze_file(flatapi: "FlatProgramAPI", outfile: Path) -> None:
-    """Analyze loaded file and write results to outfile."""
+
+def analyze_file(
+    flatapi: "FlatProgramAPI",
+    outfile: Path,
+    profile: str = "full",
+    time_budget: float | None = None,
+) -> None:
+    """
+    Analyze loaded file and write results to outfile. Analysis exceeding
+    time_budget seconds is cancelled and the references found so far are
+    written as a truncated result.
+    """
+
+    # pylint: disable=import-outside-toplevel
+    from ghidra.program.flatapi import FlatProgramAPI
+    from ghidra.util.exception import CancelledException
+    from ghidra.util.task import TaskMonitorAdapter, TimeoutTaskMonitor
+    from java.util.concurrent import TimeUnit
 
     program = flatapi.getCurrentProgram()
     memory = program.memory
@@ -86,32 +190,145 @@ def analyze_file(flatapi: "FlatProgramAPI", outfile: Path) -> None:
         block.setRead(True)
         block.setWrite(False)
         block.setExecute(True)
-    flatapi.analyzeAll(program)
+    configure_analyzers(program, profile)
+
+    monitor: "TaskMonitor"
+    if time_budget is None:
+        monitor = TaskMonitorAdapter(True)
+    else:
+        monitor = TimeoutTaskMonitor.timeoutIn(
+            int(time_budget * 1000), TimeUnit.MILLISECONDS
+        )
+    with stage("analyze_all", output=outfile, profile=profile) as record:
+        try:
+            FlatProgramAPI(program, monitor).analyzeAll(program)
+        except CancelledException:
+            pass
+        record["truncated"] = bool(monitor.isCancelled())
+
+    with stage("references", output=outfile):
+        result = memory_references(program)
+    result.truncated = bool(monitor.isCancelled())
+    dump_access_map(result, outfile)
+
+
+def memory_references(program: "Program") -> AnalysisResult:
+    """
+    Collect the words read and written by an analyzed program.
+
+    The references are taken in one pass from the reference manager, which
+    only visits addresses that have references, instead of asking every
+    instruction for its references. This is no bulk extraction: each
+    reference still costs five calls into the JVM, for its memory flag, type,
+    type name, destination and offset. Fetching them as primitive arrays in
+    one call per batch would take a Java helper compiled against Ghidra.
+    """
 
-    instruction = flatapi.firstInstruction
     reads: set[int] = set()
     writes: set[int] = set()
-    while instruction is not None:
-        for ref in instruction.referencesFrom:
-            if ref.stackReference:
-                continue
-            if ref.referenceType.read:
-                reads.add((int(ref.toAddress.offset) // 4) * 4)
-            if ref.referenceType.write:
-                writes.add((int(ref.toAddress.offset) // 4) * 4)
-        instruction = instruction.next
-    outfile.write_text(AnalysisResult(read=reads, write=writes).model_dump_json())
+    # one call for the type name saves the two flag lookups per reference
+    kinds: dict[str, tuple[bool, bool]] = {}
+    references = program.referenceManager.getReferenceIterator(program.minAddress)
+    for ref in references:
+        # stack, register and external references have no word in memory
+        if not ref.memoryReference:
+            continue
+        ref_type = ref.referenceType
+        name = str(ref_type)
+        if name not in kinds:
+            kinds[name] = (bool(ref_type.read), bool(ref_type.write))
+        read, write = kinds[name]
+        if not (read or write):
+            continue
+        word = (int(ref.toAddress.offset) // 4) * 4
+        if read:
+            reads.add(word)
+        if write:
+            writes.add(word)
+    return AnalysisResult(read=reads, write=writes)
+
+
+LANGUAGE = "ARM:LE:32:Cortex"
+
+
+def ghidra_version(ghidra_dir: Path) -> str:
+    """Read the version of a Ghidra installation."""
+    properties = ghidra_dir / "Ghidra" / "application.properties"
+    for line in properties.read_text().splitlines():
+        key, _, value = line.partition("=")
+        if key.strip() == "application.version":
+            return value.strip()
+    raise ValueError(f"No version found in {properties}.")
+
+
+def cache_key(file: Path, version: str, profile: str = "full") -> str:
+    """
+    Key of a binary's access map in the cache: the content hash, the Ghidra
+    version and the analysis options.
+    """
+    with file.open("rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    return f"sha256={digest};ghidra={version};language={LANGUAGE};profile={profile}"
+
+
+def start_ghidra(ghidra_dir: Path) -> None:
+    """Start the Ghidra JVM of this process."""
+
+    # pyghidra is slow to import, consumers of AnalysisResult do not need it
+    import pyghidra  # pylint: disable=import-outside-toplevel
+
+    with stage("start_ghidra"):
+        pyghidra.start(install_dir=ghidra_dir)
+
+
+def analyze_binary(
+    task: tuple[Path, Path], profile: str = "full", time_budget: float | None = None
+) -> None:
+    """Load a firmware binary into the running Ghidra and analyze it."""
+
+    import pyghidra  # pylint: disable=import-outside-toplevel
+
+    file, outfile = task
+    with stage("analyze_binary", file=file, output=outfile), ExitStack() as stack:
+        tmpdir = stack.enter_context(TemporaryDirectory())
+        with stage("open_program", file=file):
+            api = stack.enter_context(
+                pyghidra.open_program(
+                    file, analyze=False, language=LANGUAGE, project_location=tmpdir
+                )
+            )
+        analyze_file(api, outfile, profile, time_budget)
 
 
 def analyze(
-    source: Path, destination: Path, ghidra_dir: Path = Path("deps/ghidra")
+    source: Path,
+    destination: Path,
+    ghidra_dir: Path = Path("deps/ghidra"),
+    jobs: int = 1,
+    cache_prefix: Path | None = Path("deps/access_maps"),
+    profile: str = "full",
+    time_budget: float | None = None,
+    output_format: str = "json",
 ) -> None:
-    """Identify xrefs in firmware binaries."""
+    """
+    Identify xrefs in firmware binaries. With more than one job, binaries are
+    analyzed in worker processes with a JVM each, and a failing binary does
+    not abort the batch.
+
+    Access maps are cached in the storage at cache_prefix, keyed by content
+    hash, Ghidra version and analysis options. Only binaries missing from the
+    cache are analyzed, and identical binaries only once. Access maps truncated
+    by the time budget are not cached.
+    """
+
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown analysis profile {profile}.")
 
     destination.mkdir(exist_ok=True,parents=True)
 
-    install_ghidra(ghidra_dir)
-    pyghidra.start(install_dir=ghidra_dir)
+    with stage("install_ghidra"):
+        install_ghidra(ghidra_dir)
+    version = ghidra_version(ghidra_dir)
 
     if source.is_dir():
         files = source.rglob("*")
@@ -120,13 +337,132 @@ def analyze(
     else:
         raise ValueError(f"Source {source} is neither a file nor a directory.")
 
+    # outputs mirror the source tree, so equal names in different dirs coexist
+    tasks: dict[str, list[tuple[Path, Path]]] = {}
     for file in files:
         if not file.is_file():
             continue
-        with TemporaryDirectory() as tmpdir, pyghidra.open_program(
-            file, analyze=False, language="ARM:LE:32:Cortex", project_location=tmpdir
-        ) as api:
-            analyze_file(api, (destination / file.with_suffix(".json").name))
+        relative = file.relative_to(source) if source.is_dir() else Path(file.name)
+        outfile = destination / relative.with_suffix(
+            ACCESS_MAP_SUFFIXES[output_format]
+        )
+        outfile.parent.mkdir(parents=True, exist_ok=True)
+        tasks.setdefault(cache_key(file, version, profile), []).append(
+            (file, outfile)
+        )
+
+    cache = None
+    if cache_prefix is not None:
+        cache_prefix.parent.mkdir(parents=True, exist_ok=True)
+        cache = Storage(cache_prefix, binary=True)
+        for key in [key for key in tasks if key in cache]:
+            for file, outfile in tasks.pop(key):
+                print(f"Using cached access map of {file}.")
+                dump_access_map(cache.get_and_unserialize(key, AnalysisResult), outfile)
+
+    def finish(key: str) -> None:
+        """Cache an analyzed access map and copy it to duplicate binaries."""
+        (file, analyzed), *duplicates = tasks[key]
+        result = load_access_map(analyzed)
+        if result.truncated:
+            print(f"Analysis of {file} exceeded the time budget, map is partial.")
+        elif cache is not None:
+            cache[key] = result
+        for _, outfile in duplicates:
+            dump_access_map(result, outfile)
+
+    if not tasks:
+        return
+
+    analyze_task = partial(analyze_binary, profile=profile, time_budget=time_budget)
+    if jobs <= 1:
+        start_ghidra(ghidra_dir)
+        for key, (task, *_) in tasks.items():
+            analyze_task(task)
+            finish(key)
+        return
+
+    keys = {task: key for key, (task, *_) in tasks.items()}
+    failed = 0
+    for (file, outfile), outcome in isolated_map(
+        analyze_task, keys, jobs, initializer=start_ghidra, initargs=(ghidra_dir,)
+    ):
+        if isinstance(outcome, Failure):
+            failed += 1
+            print(f"Failed to analyze {file}: {outcome.reason}")
+        else:
+            finish(keys[file, outfile])
+            print(f"Analyzed {file} into {outfile}.")
+    if failed:
+        print(f"{failed} binaries failed.")
+
 
 if __name__ == "__main__":
-    analyze(Path(sys.argv[1]), Path(sys.argv[2]))
+    parser = argparse.ArgumentParser(
+        description="Build access maps of firmware binaries with Ghidra."
+    )
+    parser.add_argument("source", type=Path, help="Firmware binary or directory.")
+    parser.add_argument("destination", type=Path, help="Output directory.")
+    parser.add_argument(
+        "--ghidra-dir",
+        type=Path,
+        default=Path("deps/ghidra"),
+        help="Ghidra installation, downloaded if missing.",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of analysis processes, each running its own JVM.",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        default=Path("deps/access_maps"),
+        help="Prefix of the access map cache storage.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_const",
+        const=None,
+        help="Analyze all binaries, without consulting or filling the cache.",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=list(PROFILES),
+        default="full",
+        help="Analyzers to run, refs-only runs just those needed for references.",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=None,
+        help="Seconds of analysis per binary, after which a partial access map "
+        "marked as truncated is written.",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="Append wall time, CPU time and peak memory of every stage to this "
+        "JSON Lines file.",
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(ACCESS_MAP_SUFFIXES),
+        default="json",
+        help="Format of the access maps, binary is smaller and faster to read.",
+    )
+    args = parser.parse_args()
+    instrumentation.configure(args.report)
+    analyze(
+        args.source,
+        args.destination,
+        args.ghidra_dir,
+        args.jobs,
+        args.cache,
+        args.profile,
+        args.time_budget,
+        args.format,
+    )
@@ -1,43 +1,35 @@
 from pathlib import Path
 import sys
 
-from svdmap.model import Shadow
-from svdmap.serstor import Storage
+from svdmap.pack import load_knowledge_base
 
 
 def count_shadow_maps(knowledge_base: Path) -> None:
     """
     Determine number of shadow maps and other stats in the given knowledge base.
+    Accepts both shadow map storages and compiled packs.
     """
 
-    storage = Storage(knowledge_base)
-    print(f"Total shadow maps: {len(storage)}")
+    index = load_knowledge_base(knowledge_base)
+    print(f"Total shadow maps: {len(index)}")
 
-    equivalence_groups: dict[int, list[Shadow]] = {}
+    # equivalent shadow maps share a row of the index
+    equivalence_groups: dict[int, list[str]] = {}
 
-    for svd in storage:
-        shadow_map = storage.get_and_unserialize(svd, Shadow)
-        group_id = hash((frozenset(shadow_map.read), frozenset(shadow_map.write)))
-        if group_id not in equivalence_groups:
-            equivalence_groups[group_id] = []
-        equivalence_groups[group_id].append(shadow_map)
-
-    # check equivalence groups
-    for group in equivalence_groups.values():
-        base = group[0]
-        for shadow_map in group[1:]:
-            assert base.read == shadow_map.read
-            assert base.write == shadow_map.write
+    for name, row in zip(index.names, index.name_rows.tolist()):
+        if row not in equivalence_groups:
+            equivalence_groups[row] = []
+        equivalence_groups[row].append(name)
 
     # check that sizes add up
-    assert sum(len(g) for g in equivalence_groups.values()) == len(storage)
+    assert sum(len(g) for g in equivalence_groups.values()) == len(index)
 
     print(f"Total equivalence groups: {len(equivalence_groups)}")
 
     largest_group = max(equivalence_groups.values(), key=len)
     print(f"Largest group size: {len(largest_group)}")
-    for i, shadow_map in enumerate(largest_group):
-        print(f"  Shadow map {i}: {shadow_map.name}")
+    for i, name in enumerate(largest_group):
+        print(f"  Shadow map {i}: {name}")
 
 
 count_shadow_maps(Path(sys.argv[1]))
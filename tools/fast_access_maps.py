@@ -0,0 +1,396 @@
+"""Ghidra-free extraction of peripheral accesses from Cortex-M firmware images."""
+
+import argparse
+import struct
+from collections.abc import Iterator
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import numpy.typing as npt
+
+from build_access_maps import (
+    ACCESS_MAP_SUFFIXES,
+    AnalysisResult,
+    dump_access_map,
+    load_access_map,
+)
+from svdmap.pack import load_knowledge_base
+from svdmap.ranking import IncrementalRanker
+
+type Segment = tuple[int, bytes]
+type UIntArray = npt.NDArray[np.int64]
+
+# number of instructions after loading a base address to look for accesses
+WINDOW = 16
+
+# bytes of code whose accesses are emitted as one batch
+BATCH_SIZE = 0x4000
+
+
+def load_intel_hex(text: str) -> list[Segment]:
+    """Parse Intel HEX records into contiguous segments."""
+    segments: list[Segment] = []
+    upper = 0
+    start = 0
+    data = bytearray()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith(":"):
+            continue
+        record = bytes.fromhex(line[1:])
+        length, offset, kind = record[0], int.from_bytes(record[1:3]), record[3]
+        payload = record[4 : 4 + length]
+        match kind:
+            case 0x00:
+                address = upper + offset
+                if data and address != start + len(data):
+                    segments.append((start, bytes(data)))
+                    data = bytearray()
+                if not data:
+                    start = address
+                data += payload
+            case 0x01:
+                break
+            case 0x02:
+                upper = int.from_bytes(payload) << 4
+            case 0x04:
+                upper = int.from_bytes(payload) << 16
+    if data:
+        segments.append((start, bytes(data)))
+    return segments
+
+
+def load_elf(image: bytes) -> list[Segment]:
+    """Extract the loadable segments of a 32 bit little endian ELF file."""
+    if image[4] != 1 or image[5] != 1:
+        raise ValueError("Only 32 bit little endian ELF files are supported.")
+    (phoff,) = struct.unpack_from("<I", image, 0x1C)
+    phentsize, phnum = struct.unpack_from("<HH", image, 0x2A)
+    segments: list[Segment] = []
+    for i in range(phnum):
+        p_type, p_offset, p_vaddr, _, p_filesz = struct.unpack_from(
+            "<IIIII", image, phoff + i * phentsize
+        )
+        if p_type == 1 and p_filesz:  # PT_LOAD
+            segments.append((p_vaddr, image[p_offset : p_offset + p_filesz]))
+    return segments
+
+
+def load_image(file: Path) -> list[Segment]:
+    """
+    Load a firmware image as segments of (address, data). Raw images are
+    loaded at address 0, like Ghidra's raw binary loader does.
+    """
+    image = file.read_bytes()
+    if image.startswith(b"\x7fELF"):
+        return load_elf(image)
+    if file.suffix == ".hex":
+        return load_intel_hex(image.decode("ascii"))
+    return [(0, image)]
+
+
+def _read_u32(data: npt.NDArray[np.uint8], offsets: UIntArray) -> UIntArray:
+    """Read little endian words at the given byte offsets of data."""
+    return (
+        data[offsets].astype(np.int64)
+        | data[offsets + 1].astype(np.int64) << 8
+        | data[offsets + 2].astype(np.int64) << 16
+        | data[offsets + 3].astype(np.int64) << 24
+    )
+
+
+def _segment_batches(
+    address: int, segment: bytes, batch_size: int = BATCH_SIZE
+) -> Iterator[tuple[set[int], set[int]]]:
+    """
+    Find read and written words of one segment of Thumb code, in batches of
+    the accesses based on loads within batch_size bytes of code.
+    """
+
+    data = np.frombuffer(segment, dtype=np.uint8)
+    hw = np.frombuffer(segment[: len(segment) & ~1], dtype="<u2").astype(np.int64)
+    n = len(hw)
+    nxt = np.zeros(n, dtype=np.int64)
+    nxt[:-1] = hw[1:]
+    pc = address + 2 * np.arange(n, dtype=np.int64) + 4
+
+    # instruction length in halfwords, 32 bit encodings start with 0b111xx
+    length = np.where((hw >> 11) >= 0x1D, 2, 1)
+
+    # base addresses loaded into registers: position after the load, register,
+    # value and, for literal loads, the literal's address
+    positions: list[UIntArray] = []
+    registers: list[UIntArray] = []
+    values: list[UIntArray] = []
+    literals: list[UIntArray] = []
+
+    def add_literal_loads(
+        where: UIntArray, rt: UIntArray, literal: UIntArray, size: int
+    ) -> None:
+        inside = (literal >= address) & (literal + 4 <= address + len(segment))
+        where, rt, literal = where[inside], rt[inside], literal[inside]
+        positions.append(where + size)
+        registers.append(rt)
+        values.append(_read_u32(data, literal - address))
+        literals.append(literal)
+
+    # LDR Rt, [PC, #imm8 * 4]
+    where = np.flatnonzero((hw & 0xF800) == 0x4800)
+    add_literal_loads(
+        where,
+        (hw[where] >> 8) & 0x7,
+        (pc[where] & ~3) + (hw[where] & 0xFF) * 4,
+        1,
+    )
+
+    # LDR.W Rt, [PC, #+/-imm12]
+    where = np.flatnonzero(((hw & 0xFF7F) == 0xF85F) & ((nxt >> 12) != 15))
+    sign = np.where(hw[where] & 0x80, 1, -1)
+    add_literal_loads(
+        where, nxt[where] >> 12, (pc[where] & ~3) + sign * (nxt[where] & 0xFFF), 2
+    )
+
+    # MOVW Rd, #imm16 followed by MOVT Rd, #imm16
+    imm16 = (
+        (hw & 0xF) << 12 | ((hw >> 10) & 1) << 11 | ((nxt >> 12) & 7) << 8 | nxt & 0xFF
+    )
+    rd = (nxt >> 8) & 0xF
+    wide = (nxt & 0x8000) == 0
+    movw = wide & ((hw & 0xFBF0) == 0xF240)
+    movt = wide & ((hw & 0xFBF0) == 0xF2C0)
+    where = np.flatnonzero(movw)
+    paired = np.zeros(len(where), dtype=np.bool_)
+    for distance in range(2, 10, 2):
+        after = np.minimum(where + distance, n - 1)
+        match = ~paired & movt[after] & (rd[after] == rd[where])
+        positions.append(after[match] + 2)
+        registers.append(rd[where[match]])
+        values.append(imm16[after[match]] << 16 | imm16[where[match]])
+        literals.append(np.full(np.count_nonzero(match), -1, dtype=np.int64))
+        paired |= match
+
+    # loads and stores with immediate offsets: base register, transferred
+    # register, byte offset and whether it is a store, -1 if no access
+    acc_rn = np.full(n, -1, dtype=np.int64)
+    acc_rt = np.full(n, -1, dtype=np.int64)
+    acc_offset = np.zeros(n, dtype=np.int64)
+    acc_write = np.zeros(n, dtype=np.bool_)
+    narrow = {0x0C: (4, True), 0x0D: (4, False), 0x0E: (1, True), 0x0F: (1, False)}
+    narrow |= {0x10: (2, True), 0x11: (2, False)}
+    for opcode, (scale, store) in narrow.items():
+        where = np.flatnonzero((hw >> 11) == opcode)
+        acc_rn[where] = (hw[where] >> 3) & 0x7
+        acc_rt[where] = hw[where] & 0x7
+        acc_offset[where] = ((hw[where] >> 6) & 0x1F) * scale
+        acc_write[where] = store
+    for opcode, store in {
+        0xF8D0: False, 0xF8C0: True, 0xF890: False, 0xF880: True,
+        0xF8B0: False, 0xF8A0: True, 0xF990: False, 0xF9B0: False,
+    }.items():  # fmt: skip
+        where = np.flatnonzero((hw & 0xFFF0) == opcode)
+        acc_rn[where] = hw[where] & 0xF
+        acc_rt[where] = nxt[where] >> 12
+        acc_offset[where] = nxt[where] & 0xFFF
+        acc_write[where] = store
+
+    # control flow ends the tracking of a base register
+    branch = (
+        ((hw & 0xF800) == 0xE000)  # B
+        | ((hw & 0xFF00) == 0x4700)  # BX, BLX
+        | ((hw & 0xFF00) == 0xBD00)  # POP {..., PC}
+        | (((hw & 0xF800) == 0xF000) & ((nxt & 0xD000) == 0xD000))  # BL
+    )
+
+    position = np.concatenate(positions)
+    order = np.argsort(position, kind="stable")
+    position = position[order]
+    register = np.concatenate(registers)[order]
+    base = np.concatenate(values)[order]
+    literal = np.concatenate(literals)[order]
+    # loads are batched by position, in halfwords
+    step = max(batch_size // 2, 1)
+    bounds = np.searchsorted(position, np.arange(step, n, step)).tolist()
+    bounds = [0, *bounds, len(position)]
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo == hi:
+            continue
+        current = position[lo:hi]
+        tracked = register[lo:hi]
+        literal_words = literal[lo:hi]
+        reads: set[int] = set((literal_words[literal_words >= 0] & ~3).tolist())
+        writes: set[int] = set()
+        alive = (current < n) & (tracked != 13) & (tracked != 15)
+        for _ in range(WINDOW):
+            current = np.minimum(current, n - 1)
+            hit = alive & (acc_rn[current] == tracked)
+            target = base[lo:hi][hit] + acc_offset[current[hit]]
+            stores = acc_write[current[hit]]
+            reads.update((target[~stores] & ~3).tolist())
+            writes.update((target[stores] & ~3).tolist())
+
+            # loading into the base register or branching ends its tracking
+            overwritten = (acc_rt[current] == tracked) & ~acc_write[current]
+            alive &= ~overwritten & ~branch[current]
+            current = current + length[current]
+            alive &= current < n
+
+        yield (
+            {a for a in reads if 0 <= a <= 0xFFFF_FFFF},
+            {a for a in writes if 0 <= a <= 0xFFFF_FFFF},
+        )
+
+
+def iter_extract(file: Path, batch_size: int = BATCH_SIZE) -> Iterator[AnalysisResult]:
+    """
+    Extract the read and written words of a firmware image in batches, each
+    covering the accesses found in batch_size bytes of code.
+    """
+    for address, segment in load_image(file):
+        for reads, writes in _segment_batches(address, segment, batch_size):
+            yield AnalysisResult(read=reads, write=writes)
+
+
+def extract(file: Path) -> AnalysisResult:
+    """Extract the read and written words of a firmware image."""
+    reads: set[int] = set()
+    writes: set[int] = set()
+    for batch in iter_extract(file):
+        reads |= batch.read
+        writes |= batch.write
+    return AnalysisResult(read=reads, write=writes)
+
+
+def _files(source: Path) -> list[tuple[Path, Path]]:
+    """Firmware images below source, with their path relative to source."""
+    if source.is_file():
+        return [(source, Path(source.name))]
+    return [
+        (file, file.relative_to(source))
+        for file in sorted(source.rglob("*"))
+        if file.is_file()
+    ]
+
+
+def extract_all(source: Path, destination: Path, output_format: str = "json") -> None:
+    """Write access maps of all firmware images in source to destination."""
+    for file, relative in _files(source):
+        started = perf_counter()
+        outfile = destination / relative.with_suffix(ACCESS_MAP_SUFFIXES[output_format])
+        outfile.parent.mkdir(parents=True, exist_ok=True)
+        dump_access_map(extract(file), outfile)
+        print(f"Extracted {file} in {perf_counter() - started:.3f}s.")
+
+
+def _agreement(found: set[int], expected: set[int]) -> tuple[float, float, float]:
+    """Precision, recall and Jaccard similarity of found against expected."""
+    shared = len(found & expected)
+    union = len(found | expected)
+    return (
+        shared / len(found) if found else 1.0,
+        shared / len(expected) if expected else 1.0,
+        shared / union if union else 1.0,
+    )
+
+
+def compare(source: Path, reference: Path) -> None:
+    """
+    Compare fast access maps of the images in source to the Ghidra access
+    maps in reference, which mirror the layout of source.
+    """
+    columns = ["read P", "read R", "read J", "write P", "write R", "write J"]
+    print(f"{'firmware':<48} {'time':>7} " + " ".join(f"{c:>7}" for c in columns))
+    rows: list[list[float]] = []
+    for file, relative in _files(source):
+        expected_files = [
+            reference / relative.with_suffix(suffix)
+            for suffix in ACCESS_MAP_SUFFIXES.values()
+        ]
+        expected_file = next((f for f in expected_files if f.exists()), None)
+        if expected_file is None:
+            continue
+        expected = load_access_map(expected_file)
+        started = perf_counter()
+        found = extract(file)
+        elapsed = perf_counter() - started
+        row = [
+            elapsed,
+            *_agreement(found.read, expected.read),
+            *_agreement(found.write, expected.write),
+        ]
+        rows.append(row)
+        print(f"{str(relative):<48} " + " ".join(f"{v:>7.3f}" for v in row))
+    if rows:
+        means = np.mean(rows, axis=0).tolist()
+        print(f"{'mean':<48} " + " ".join(f"{v:>7.3f}" for v in means))
+
+
+def triage(
+    firmware: Path, knowledge_base: Path, top_k: int = 5, batch_size: int = BATCH_SIZE
+) -> None:
+    """
+    Rank a firmware image against a knowledge base while its access map is
+    being extracted, printing the provisional top_k after every batch.
+    """
+    started = perf_counter()
+    ranker = IncrementalRanker(load_knowledge_base(knowledge_base))
+    print(f"Loaded {knowledge_base} in {perf_counter() - started:.3f}s.")
+    for i, batch in enumerate(iter_extract(firmware, batch_size)):
+        ranker.add(batch.read, batch.write)
+        print(
+            f"Batch {i + 1}, {len(ranker.read)} read and {len(ranker.write)} "
+            f"written words after {perf_counter() - started:.3f}s:"
+        )
+        for name, score in ranker.iter_rank(top_k):
+            print(f"\t{score:.4f}\t{name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract access maps from Cortex-M firmware without Ghidra."
+    )
+    subparsers = parser.add_subparsers(required=True)
+    parser_extract = subparsers.add_parser(
+        "extract", help="write access maps of firmware images"
+    )
+    parser_extract.add_argument(
+        "source", type=Path, help="Firmware image or directory."
+    )
+    parser_extract.add_argument("destination", type=Path, help="Output directory.")
+    parser_extract.add_argument(
+        "--format",
+        dest="output_format",
+        choices=list(ACCESS_MAP_SUFFIXES),
+        default="json",
+        help="Format of the access maps.",
+    )
+    parser_extract.set_defaults(func=extract_all)
+    parser_compare = subparsers.add_parser(
+        "compare", help="compare against access maps built with Ghidra"
+    )
+    parser_compare.add_argument(
+        "source", type=Path, help="Firmware image or directory."
+    )
+    parser_compare.add_argument(
+        "reference", type=Path, help="Directory of Ghidra access maps."
+    )
+    parser_compare.set_defaults(func=compare)
+    parser_triage = subparsers.add_parser(
+        "triage", help="rank a firmware image progressively while extracting"
+    )
+    parser_triage.add_argument("firmware", type=Path, help="Firmware image.")
+    parser_triage.add_argument(
+        "knowledge_base", type=Path, help="Shadow map knowledge base or pack."
+    )
+    parser_triage.add_argument(
+        "--top-k", type=int, default=5, help="Number of devices to report."
+    )
+    parser_triage.add_argument(
+        "--batch-size",
+        type=lambda value: int(value, 0),
+        default=BATCH_SIZE,
+        help="Bytes of code per batch.",
+    )
+    parser_triage.set_defaults(func=triage)
+    args = vars(parser.parse_args())
+    args.pop("func")(**args)
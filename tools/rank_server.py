@@ -0,0 +1,167 @@
+"""Resident ranking service keeping knowledge bases loaded in memory."""
+
+import argparse
+import json
+import struct
+import zlib
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import error
+from pathlib import Path
+from threading import Lock
+from urllib.parse import parse_qs, urlparse
+
+from pydantic import ValidationError
+
+from build_access_maps import AnalysisResult
+from svdmap import wordsets
+from rank_shadows import find_knowledge_bases
+from svdmap.pack import load_knowledge_base
+from svdmap.ranking import ShadowIndex
+
+
+class KnowledgeBases:
+    """
+    Indexed knowledge bases of a directory, reloaded when they change on disk.
+    """
+
+    kb_dir: Path
+
+    _lock: Lock
+    _loaded: dict[str, tuple[Path, float, ShadowIndex]]
+
+    def __init__(self, kb_dir: Path) -> None:
+        self.kb_dir = kb_dir
+        self._lock = Lock()
+        self._loaded = {}
+        self.refresh()
+
+    def refresh(self) -> dict[str, ShadowIndex]:
+        """
+        Load new and changed knowledge bases, drop vanished ones. A knowledge
+        base failing to load, for example while it is still being written,
+        keeps its previous index and is retried on the next refresh.
+        """
+        with self._lock:
+            found = find_knowledge_bases(self.kb_dir)
+            for label in self._loaded.keys() - found.keys():
+                print(f"Dropping knowledge base {label}.")
+                del self._loaded[label]
+            for label, path in found.items():
+                try:
+                    mtime = path.stat().st_mtime
+                    loaded = self._loaded.get(label)
+                    if loaded is not None and loaded[:2] == (path, mtime):
+                        continue
+                    print(f"Loading knowledge base {label} from {path}...")
+                    self._loaded[label] = (path, mtime, load_knowledge_base(path))
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    error(f"Failed to load knowledge base {label} from {path}: {e}")
+            return {label: index for label, (_, _, index) in self._loaded.items()}
+
+
+def make_handler(knowledge_bases: KnowledgeBases) -> type[BaseHTTPRequestHandler]:
+    """Create a request handler serving the given knowledge bases."""
+
+    class RankingHandler(BaseHTTPRequestHandler):
+        """
+        GET /knowledge-bases lists the knowledge bases.
+        POST /rank ranks the AnalysisResult in the body, either as JSON or as a
+        binary word set frame. The optional query
+        parameters kb, top_k and min_score select knowledge bases and limit the
+        ranking.
+        """
+
+        def _reply(self, status: HTTPStatus, body: object) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:  # pylint: disable=invalid-name
+            """List the loaded knowledge bases."""
+            if urlparse(self.path).path != "/knowledge-bases":
+                self._reply(HTTPStatus.NOT_FOUND, {"error": "Unknown endpoint."})
+                return
+            self._reply(
+                HTTPStatus.OK,
+                {
+                    label: {"shadow_maps": len(index), "distinct": index.n_rows}
+                    for label, index in knowledge_bases.refresh().items()
+                },
+            )
+
+        def do_POST(self) -> None:  # pylint: disable=invalid-name
+            """Rank an access map."""
+            url = urlparse(self.path)
+            if url.path != "/rank":
+                self._reply(HTTPStatus.NOT_FOUND, {"error": "Unknown endpoint."})
+                return
+            query = parse_qs(url.query)
+            try:
+                top_k = int(query["top_k"][0]) if "top_k" in query else None
+                min_score = (
+                    float(query["min_score"][0]) if "min_score" in query else None
+                )
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if wordsets.is_frame(body):
+                    firmware = AnalysisResult.from_bytes(body)
+                else:
+                    firmware = AnalysisResult.model_validate_json(body)
+            except (ValueError, ValidationError, struct.error, zlib.error) as e:
+                # malformed binary frames fail in struct or zlib
+                self._reply(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+                return
+
+            indices = knowledge_bases.refresh()
+            if "kb" in query:
+                unknown = set(query["kb"]) - indices.keys()
+                if unknown:
+                    self._reply(
+                        HTTPStatus.NOT_FOUND,
+                        {"error": f"Unknown knowledge bases {sorted(unknown)}."},
+                    )
+                    return
+                indices = {label: indices[label] for label in query["kb"]}
+
+            try:
+                rankings = {
+                    label: [
+                        {"name": name, "score": score}
+                        for name, score in index.iter_rank(
+                            firmware.read, firmware.write, top_k, min_score
+                        )
+                    ]
+                    for label, index in indices.items()
+                }
+            except ValueError as e:
+                self._reply(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+                return
+            self._reply(HTTPStatus.OK, rankings)
+
+    return RankingHandler
+
+
+def serve(kb_dir: Path, host: str, port: int) -> None:
+    """Serve rankings against the knowledge bases in kb_dir until interrupted."""
+    knowledge_bases = KnowledgeBases(kb_dir)
+    with ThreadingHTTPServer((host, port), make_handler(knowledge_bases)) as server:
+        print(f"Serving rankings on http://{host}:{port}/rank")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve rankings of access maps against shadow map knowledge "
+        "bases kept in memory."
+    )
+    parser.add_argument("kb_dir", type=Path, help="Directory of knowledge bases.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8400, help="Port to listen on.")
+    args = parser.parse_args()
+    serve(args.kb_dir, args.host, args.port)
@@ -1,68 +1,311 @@
+import argparse
+import csv
+import json
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from io import StringIO
+from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-import sys
 
-from svdmap.serstor import Storage
-from svdmap.model import Shadow
-from build_access_maps import AnalysisResult
+from svdmap import instrumentation
+from svdmap.instrumentation import stage
+from svdmap.pack import (
+    PACK_SUFFIX,
+    SharedPack,
+    attach_pack,
+    load_knowledge_base,
+    pack_path,
+)
+from svdmap.ranking import METRICS, ShadowIndex
+from build_access_maps import ACCESS_MAP_SUFFIXES, load_access_map
 from logging import info
 
 
-def _print_ranking(ranking: list[tuple[str, float]]) -> str:
-    out = ""
-
+def _format_ranking(ranking: Iterable[tuple[str, float]]) -> Iterator[str]:
+    best: float | None = None
     last_score: float | None = None
     rank = 1
     with_this_rank = 0
     for name, s in ranking:
+        if best is None:
+            best = s
         if s != last_score:
             last_score = s
             if with_this_rank > 0:
-                out += f"{with_this_rank} devices with rank #{rank-1}\n"
-            out += f"Rank #{rank}: (score {s}, normalized score {s/ranking[0][1]})\n"
+                yield f"{with_this_rank} devices with rank #{rank-1}\n"
+            yield f"Rank #{rank}: (score {s}, normalized score {s/best})\n"
             rank += 1
             with_this_rank = 0
         with_this_rank += 1
 
-        out += f"\t{name}\n"
+        yield f"\t{name}\n"
 
     if with_this_rank > 0:
-        out += f"{with_this_rank} devices with rank #{rank}"
+        yield f"{with_this_rank} devices with rank #{rank}"
+
+
+def _print_ranking(ranking: list[tuple[str, float]]) -> str:
+    return "".join(_format_ranking(ranking))
+
+
+def _group_ranking(
+    ranking: Iterable[tuple[str, float]],
+) -> Iterator[tuple[int, float, float, list[str]]]:
+    """Group a ranking into rank, score, normalized score and names."""
+    best: float | None = None
+    rank = 0
+    names: list[str] = []
+    last_score = 0.0
+    for name, score in ranking:
+        if best is None:
+            best = score
+        if names and score != last_score:
+            yield rank, last_score, last_score / best if best else 0.0, names
+            names = []
+        if not names:
+            rank += 1
+            last_score = score
+        names.append(name)
+    if names:
+        yield rank, last_score, last_score / best if best else 0.0, names
+
+
+def _format_jsonl(ranking: Iterable[tuple[str, float]]) -> Iterator[str]:
+    for rank, score, normalized, names in _group_ranking(ranking):
+        record = {
+            "rank": rank,
+            "score": score,
+            "normalized_score": normalized,
+            "names": names,
+        }
+        yield json.dumps(record) + "\n"
+
+
+def _format_csv(ranking: Iterable[tuple[str, float]]) -> Iterator[str]:
+    out = StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(["rank", "score", "normalized_score", "name"])
+    for rank, score, normalized, names in _group_ranking(ranking):
+        for name in names:
+            writer.writerow([rank, score, normalized, name])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
 
-    return out
+
+# file suffix and formatter of each output format
+FORMATS = {
+    "text": (".txt", _format_ranking),
+    "jsonl": (".jsonl", _format_jsonl),
+    "csv": (".csv", _format_csv),
+}
+
+
+def _print_metrics(
+    table: Iterable[tuple[str, list[float]]], metrics: Sequence[str]
+) -> str:
+    out = StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow(["name", *metrics])
+    for name, values in table:
+        writer.writerow([name, *values])
+    return out.getvalue()
+
+
+@dataclass(frozen=True)
+class RankingOptions:
+    """What to rank and how to report it."""
+
+    format: str = "text"
+    top_k: int | None = None
+    min_score: float | None = None
+    metrics: Sequence[str] = ()
+
+
+def rank_access_map(index: ShadowIndex, firmware_shadow: Path) -> str:
+    """
+    Rank all devices in an indexed knowledge base by Shadow Jaccard similarity
+    to the given memory dump.
+    """
+    firmware = load_access_map(firmware_shadow)
+
+    info("Sorting by similarity...")
+    ranking = index.rank(firmware.read, firmware.write)
+    return _print_ranking(ranking)
 
 
 def rank_shadow_jaccard(device_shadow: Path, firmware_shadow: Path) -> str:
     """
     Rank all known devices by Shadow Jaccard similarity to the given memory dump.
     """
-    with Storage(device_shadow) as storage:
-        shadow_base = [storage.get_and_unserialize(name, Shadow) for name in storage]
-    firmware = AnalysisResult.model_validate_json(firmware_shadow.read_text())
-
-    ranks: dict[str, float] = {}
-    for shadow in shadow_base:
-        intersection = len(shadow.read & firmware.read) + len(
-            shadow.write & firmware.write
+    return rank_access_map(load_knowledge_base(device_shadow), firmware_shadow)
+
+
+def evaluate_access_map(
+    index: ShadowIndex,
+    firmware_shadow: Path,
+    label: str,
+    options: RankingOptions = RankingOptions(),
+) -> list[Path]:
+    """
+    Rank an access map against the knowledge base labeled label, streaming the
+    ranking into a file in the directory next to the access map. If metrics
+    are given, also tabulate them as CSV with one column per metric. Returns
+    the written files.
+    """
+    with stage("rank", file=firmware_shadow, kb=label):
+        firmware = load_access_map(firmware_shadow)
+        (ranks_dir := firmware_shadow.with_suffix("")).mkdir(exist_ok=True)
+
+        suffix, formatter = FORMATS[options.format]
+        written = [ranks_dir / f"ranking_using_{label}{suffix}"]
+        ranking = index.iter_rank(
+            firmware.read, firmware.write, options.top_k, options.min_score
         )
-        union = len(shadow.read | firmware.read) + len(shadow.write | firmware.write)
-        similarity = intersection / union if union > 0 else 0.0
-        ranks[shadow.name] = similarity
+        with written[0].open("w") as out:
+            out.writelines(formatter(ranking))
 
-    info("Sorting by similarity...")
-    ranking = sorted(ranks.items(), key=lambda x: x[1], reverse=True)
-    return _print_ranking(ranking)
+        if options.metrics:
+            table = index.metric_table(firmware.read, firmware.write, options.metrics)
+            written.append(ranks_dir / f"metrics_using_{label}.csv")
+            written[1].write_text(_print_metrics(table, options.metrics))
+    return written
+
+
+_worker_memory: SharedMemory | None = None
+_worker_index: ShadowIndex | None = None
+
+
+def _init_worker(shared_pack: str) -> None:
+    """Attach a ranking worker to the shared knowledge base."""
+    global _worker_memory, _worker_index  # pylint: disable=global-statement
+    _worker_memory, _worker_index = attach_pack(shared_pack)
 
 
-def main(outdir: Path, kb_dir: Path) -> None:
-    for access_map in outdir.rglob("**/*.json"):
-        print(f"Ranking access map {access_map}...")
-        (ranks_dir := access_map.with_suffix("")).mkdir(exist_ok=True)
-        for shadow_file in kb_dir.glob("shadow_maps*.tar.gz"):
-            print(f"  Using shadow map {shadow_file}...")
+def _evaluate_in_worker(
+    label: str, options: RankingOptions, firmware_shadow: Path
+) -> list[Path]:
+    """Evaluate an access map against the knowledge base of this worker."""
+    assert _worker_index is not None
+    return evaluate_access_map(_worker_index, firmware_shadow, label, options)
+
+
+def rank_batch(
+    index: ShadowIndex,
+    access_maps: list[Path],
+    label: str,
+    jobs: int = 1,
+    options: RankingOptions = RankingOptions(),
+) -> Iterator[tuple[Path, list[Path]]]:
+    """
+    Evaluate many access maps against one knowledge base, optionally in
+    parallel. Parallel workers share a single copy of the knowledge base.
+    """
+    if jobs <= 1:
+        for access_map in access_maps:
+            yield access_map, evaluate_access_map(index, access_map, label, options)
+        return
+
+    with SharedPack(index) as shared, ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker, initargs=(shared.name,)
+    ) as executor:
+        yield from zip(
+            access_maps,
+            executor.map(partial(_evaluate_in_worker, label, options), access_maps),
+        )
+
+
+def find_knowledge_bases(kb_dir: Path) -> dict[str, Path]:
+    """
+    Find shadow map knowledge bases in kb_dir, keyed by their label.
+
+    A compiled pack replaces its tarball unless the tarball is newer.
+    """
+    # labels keep the historical "<name>.tar" used in ranking file names
+    knowledge_bases: dict[str, Path] = {}
+    for shadow_file in kb_dir.glob("shadow_maps*.tar.gz"):
+        packed = pack_path(shadow_file)
+        if packed.exists() and packed.stat().st_mtime >= shadow_file.stat().st_mtime:
+            shadow_file = packed
+        knowledge_bases[pack_path(shadow_file).stem + ".tar"] = shadow_file
+    for packed in kb_dir.glob(f"shadow_maps*{PACK_SUFFIX}"):
+        knowledge_bases.setdefault(packed.stem + ".tar", packed)
+    return knowledge_bases
+
 
-            (ranks_dir / f"ranking_using_{shadow_file.stem}.txt").write_text(
-                rank_shadow_jaccard(shadow_file, access_map)
-            )
+def main(
+    outdir: Path,
+    kb_dir: Path,
+    jobs: int = 1,
+    options: RankingOptions = RankingOptions(),
+) -> None:
+    """Rank all access maps in outdir against all knowledge bases in kb_dir."""
+    access_maps = [
+        access_map
+        for suffix in ACCESS_MAP_SUFFIXES.values()
+        for access_map in outdir.rglob(f"**/*{suffix}")
+    ]
+    for label, shadow_file in find_knowledge_bases(kb_dir).items():
+        print(f"Using shadow map {shadow_file}...")
+        with stage("load_kb", kb=label, path=shadow_file):
+            index = load_knowledge_base(shadow_file)
+        for access_map, _ in rank_batch(index, access_maps, label, jobs, options):
+            print(f"  Ranked access map {access_map}.")
 
 
-main(Path(sys.argv[1]), Path(sys.argv[2]))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Rank access maps against shadow map knowledge bases."
+    )
+    parser.add_argument("outdir", type=Path, help="Directory of access maps.")
+    parser.add_argument("kb_dir", type=Path, help="Directory of knowledge bases.")
+    parser.add_argument(
+        "--jobs", type=int, default=1, help="Number of ranking processes."
+    )
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="text",
+        help="Format of the ranking files. Defaults to the original text format.",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=None,
+        help="Only report the k best devices, and devices tied with them.",
+    )
+    parser.add_argument(
+        "--min-score",
+        type=float,
+        default=None,
+        help="Only report devices scoring at least this.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=lambda value: value.split(","),
+        default=[],
+        help="Comma separated metrics to tabulate, ordered by the first one. "
+        f"Available: {', '.join(METRICS)}.",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="Append wall time, CPU time and peak memory of every stage to this "
+        "JSON Lines file.",
+    )
+    args = parser.parse_args()
+    instrumentation.configure(args.report)
+    if unknown := set(args.metrics) - set(METRICS):
+        parser.error(f"Unknown metrics {', '.join(sorted(unknown))}.")
+    if args.top_k is not None and args.top_k < 1:
+        parser.error("--top-k must be positive.")
+    main(
+        args.outdir,
+        args.kb_dir,
+        args.jobs,
+        RankingOptions(args.format, args.top_k, args.min_score, args.metrics),
+    )
@@ -1,12 +1,30 @@
 """Build a memory map from an SVD file."""
 
+import json
+import os
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import batched
 from pathlib import Path
 
+import numpy as np
+import numpy.typing as npt
+
 from .serstor import Storage
+from .serstor.abstract import NativeSerializable
 
-from .model import MemoryMap, Shadow
+from .instrumentation import stage
+from .model import Address, MemoryMap, Shadow
 from .parallelization import Result
 
+# memory maps handed to a make-shadows worker at once
+_SHADOW_CHUNK = 64
+
+type _ShadowWords = tuple[
+    tuple[bytes, bytes], npt.NDArray[np.int64], npt.NDArray[np.int64]
+]
+
 
 def check_storage(prefix: Path) -> None:
     """Check the storage for errors."""
@@ -26,31 +44,127 @@ def check_storage(prefix: Path) -> None:
     print("Storage has been read successfully.")
 
 
-def make_shadows(prefix: Path, output_prefix: Path, output_dir: Path | None) -> None:
-    """Create shadow files for all memory maps in storage."""
+def _words(values: NativeSerializable) -> npt.NDArray[np.int64]:
+    """
+    Words covered by serialized register values, in the order set.add would
+    have seen them expanding the values one by one.
+    """
+    if not isinstance(values, list):
+        raise TypeError("Expected a list of values")
+    starts: list[str] = []
+    sizes: list[str] = []
+    for value in values:
+        if not isinstance(value, dict):
+            raise TypeError("Expected dict")
+        location = value["location"]
+        if not isinstance(location, dict):
+            raise TypeError("Expected dict")
+        start, size = location["start"], location["size"]
+        if not isinstance(start, str) or not isinstance(size, str):
+            raise TypeError("Expected str")
+        starts.append(start)
+        sizes.append(size)
+    # sizes and the addresses of registers listed twice recur, parse each once
+    bits = {data: Address.unserialize(data).bits for data in {*starts, *sizes}}
+    start = np.fromiter(map(bits.__getitem__, starts), np.int64, len(starts))
+    size = np.fromiter(map(bits.__getitem__, sizes), np.int64, len(sizes))
+
+    first = (start // 8) & ~0x3
+    last = ((start + size - 1) // 8) & ~0x3
+    counts = np.maximum((last - first) // 4 + 1, 0)
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(first, counts) + 4 * steps
+
+
+def _shadow_words(raw: str | bytes) -> _ShadowWords | None:
+    """
+    Read and written words of a serialized Result[MemoryMap], along with a key
+    equal for equal shadows, or None if the memory map failed. Decodes only
+    the register locations.
+    """
+    memory_map, error = Result.peek(json.loads(raw))
+    if error is not None:
+        return None
+    if not isinstance(memory_map, dict):
+        raise TypeError("Expected a dict of values")
+    read = _words(memory_map["read_values"])
+    write = _words(memory_map["written_values"])
+    return (np.unique(read).tobytes(), np.unique(write).tobytes()), read, write
+
+
+def _chunk_words(raws: Iterable[str | bytes]) -> list[_ShadowWords | None]:
+    """Words of a chunk of serialized memory maps."""
+    return [_shadow_words(raw) for raw in raws]
+
+
+def _iter_shadow_words(
+    storage: Storage, jobs: int | None
+) -> Iterator[tuple[str, _ShadowWords | None]]:
+    """
+    Words of all memory maps in storage, in handle order. With more than one
+    job, chunks of memory maps are processed in parallel, keeping only a few
+    chunks per process in flight.
+    """
+    if jobs == 1:
+        for svd, raw in storage.iter_raw():
+            yield svd, _shadow_words(raw)
+        return
+
+    window = 2 * (jobs or os.cpu_count() or 1)
+    with ProcessPoolExecutor(jobs) as executor:
+        pending: deque[tuple[Iterable[str], Future[list[_ShadowWords | None]]]]
+        pending = deque()
+        for chunk in batched(storage.iter_raw(), _SHADOW_CHUNK):
+            handles, raws = zip(*chunk)
+            pending.append((handles, executor.submit(_chunk_words, raws)))
+            if len(pending) >= window:
+                svds, future = pending.popleft()
+                yield from zip(svds, future.result())
+        while pending:
+            svds, future = pending.popleft()
+            yield from zip(svds, future.result())
+
+
+@stage("make_shadows")
+def make_shadows(
+    prefix: Path,
+    output_prefix: Path,
+    output_dir: Path | None,
+    binary: bool = False,
+    jobs: int | None = None,
+) -> None:
+    """
+    Create shadow files for all memory maps in storage, in jobs processes. With
+    binary, shadows are stored as compact word set frames, the shadow files
+    are JSON anyway.
+    """
 
     storage = Storage(prefix)
-    output_storage = Storage(output_prefix)
-    for svd in storage:
-        result = Result[MemoryMap].unserialize(storage[svd], MemoryMap)
-        if result.error is not None:
+    output_storage = Storage(output_prefix, binary=binary)
+    # equivalent shadows are stored once, under the name seen first
+    shadows: dict[tuple[bytes, bytes], Shadow] = {}
+    for svd, words in _iter_shadow_words(storage, jobs):
+        if words is None:
             continue
-        memory_map = result.returned
-        assert memory_map is not None
-        shadow = Shadow(read=set(), write=set(), name=svd)
-        for value in memory_map.read_values:
-            first_word = value.location.start.byte_offset & ~0x3
-            last_word = value.location.last_bit.byte_offset & ~0x3
-
-            for addr in range(first_word, last_word + 1, 4):
-                shadow.read.add(addr)
-        for value in memory_map.written_values:
-            first_word = value.location.start.byte_offset & ~0x3
-            last_word = value.location.last_bit.byte_offset & ~0x3
-            for addr in range(first_word, last_word + 1, 4):
-                shadow.write.add(addr)
-        output_storage[svd] = shadow
-    output_storage.export_tar()
+        key, read, write = words
+        if key in shadows:
+            shadows[key].aliases.append(svd)
+        else:
+            # validation copies sets, fill the copies in the original insertion
+            # order so that they serialize identically
+            shadow = Shadow(read=set(), write=set(), name=svd)
+            shadow.read.update(read.tolist())
+            shadow.write.update(write.tolist())
+            shadows[key] = shadow
+    with stage("store_shadows", count=len(shadows)):
+        # rows of an earlier run may name devices now stored as aliases
+        with output_storage.batch():
+            output_storage.clear()
+            output_storage.setmany(
+                (shadow.name, shadow) for shadow in shadows.values()
+            )
+    with stage("export_tar", prefix=output_prefix):
+        output_storage.export_tar()
 
     if output_dir is None:
         return
@@ -58,8 +172,21 @@ def make_shadows(prefix: Path, output_prefix: Path, output_dir: Path | None) ->
     output_dir.mkdir(parents=True, exist_ok=True)
     for svd in output_storage:
         entry = output_storage.getraw(svd)
-        destination = (output_dir / svd).with_suffix(".json")
-        if not destination.resolve().is_relative_to(output_dir.resolve()):
-            raise ValueError("Output directory traversal detected.")
-        destination.parent.mkdir(parents=True, exist_ok=True)
-        destination.write_text(entry)
+        if isinstance(entry, bytes):
+            shadow = Shadow.from_bytes(entry)
+            entry = shadow.model_dump_json()
+        else:
+            shadow = Shadow.model_validate_json(entry)
+        # every device gets its shadow file, including those stored as aliases
+        files = {svd: entry} | {
+            alias: shadow.model_copy(
+                update={"name": alias, "aliases": []}
+            ).model_dump_json()
+            for alias in shadow.aliases
+        }
+        for name, text in files.items():
+            destination = (output_dir / name).with_suffix(".json")
+            if not destination.resolve().is_relative_to(output_dir.resolve()):
+                raise ValueError("Output directory traversal detected.")
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            destination.write_text(text)
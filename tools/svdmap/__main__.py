@@ -3,8 +3,9 @@
 import argparse
 from pathlib import Path
 
-from . import check_storage, make_shadows
+from . import check_storage, instrumentation, make_shadows
 from .needs_gil import ingest
+from .pack import compile_kb
 from .parallelization import die
 
 
@@ -12,6 +13,13 @@ def run() -> None:
     """main routine"""
 
     parser = argparse.ArgumentParser(description="Extract memory maps from SVD files.")
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="Append wall time, CPU time and peak memory of every stage to this "
+        "JSON Lines file.",
+    )
     subparsers = parser.add_subparsers()
     parser_ingest = subparsers.add_parser(
         "ingest", help="ingest a directory of SVD files"
@@ -23,6 +31,31 @@ def run() -> None:
     parser_ingest.add_argument(
         "--timeout", type=int, default=None, help="Timeout in seconds."
     )
+    parser_ingest.add_argument(
+        "--file-timeout",
+        type=float,
+        default=300,
+        help="Seconds after which the worker parsing a file is killed.",
+    )
+    parser_ingest.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes. Defaults to the number of CPUs.",
+    )
+    parser_ingest.add_argument(
+        "--max-tasks-per-child",
+        type=int,
+        default=50,
+        help="Number of files after which a worker is replaced.",
+    )
+    parser_ingest.add_argument(
+        "--retries",
+        type=int,
+        default=1,
+        help="Number of retries of files that time out or crash their worker "
+        "before they are quarantined.",
+    )
     parser_ingest.set_defaults(func=ingest)
 
     parser_check = subparsers.add_parser(
@@ -47,8 +80,36 @@ def run() -> None:
         default=None,
         help="Path to the output directory.",
     )
+    parser_make_shadows.add_argument(
+        "--binary",
+        action="store_true",
+        help="Store shadows as compact binary word sets instead of JSON.",
+    )
+    parser_make_shadows.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes decoding memory maps. Defaults to the number "
+        "of CPUs.",
+    )
     parser_make_shadows.set_defaults(func=make_shadows)
 
+    parser_compile_kb = subparsers.add_parser(
+        "compile-kb", help="compile shadow maps in storage into a binary pack"
+    )
+    parser_compile_kb.add_argument(
+        "prefix", type=Path, help="Path to the shadow map storage file."
+    )
+    parser_compile_kb.add_argument(
+        "out",
+        type=Path,
+        nargs="?",
+        default=None,
+        help="Path to the output pack. Defaults to the storage path with suffix "
+        "'.kbpack'.",
+    )
+    parser_compile_kb.set_defaults(func=compile_kb)
+
     args = parser.parse_args()
 
     if not hasattr(args, "func"):
@@ -58,6 +119,7 @@ def run() -> None:
     func = args.func
     params = vars(args)
     del params["func"]
+    instrumentation.configure(params.pop("report"))
     func(**params)
 
     die()
@@ -0,0 +1,109 @@
+"""Wall time, CPU time and peak memory records of pipeline stages."""
+
+import json
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from threading import Event, Thread
+from time import perf_counter, time
+
+import psutil
+
+# the report path is passed through the environment, so worker processes
+# record into the same report as their parent
+REPORT_ENV = "SVDMAP_REPORT"
+
+# seconds between memory samples
+SAMPLE_INTERVAL = 0.02
+
+
+def configure(report: Path | None) -> None:
+    """Append stage records to report, or stop recording if None."""
+    if report is None:
+        os.environ.pop(REPORT_ENV, None)
+    else:
+        report.parent.mkdir(parents=True, exist_ok=True)
+        os.environ[REPORT_ENV] = str(report.resolve())
+
+
+def _rss(process: psutil.Process) -> int:
+    """Resident memory of a process and its children."""
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+class _PeakSampler(Thread):
+    """Samples the resident memory of a process tree until stopped."""
+
+    peak: int
+
+    def __init__(self, process: psutil.Process) -> None:
+        super().__init__(daemon=True)
+        self.process = process
+        self.peak = _rss(process)
+        self.stopped = Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            self.peak = max(self.peak, _rss(self.process))
+
+    def stop(self) -> int:
+        """Stop sampling and return the peak resident memory in bytes."""
+        self.stopped.set()
+        self.join()
+        return max(self.peak, _rss(self.process))
+
+
+@contextmanager
+def stage(name: str, **fields: object) -> Iterator[dict[str, object]]:
+    """
+    Record the wall time, CPU time and peak resident memory of the enclosed
+    code as one JSON line in the configured report. fields, and whatever is
+    added to the yielded dict, is recorded alongside.
+    """
+
+    report = os.environ.get(REPORT_ENV)
+    if report is None:
+        yield fields
+        return
+
+    process = psutil.Process()
+    sampler = _PeakSampler(process)
+    sampler.start()
+    started = time()
+    wall = perf_counter()
+    cpu = process.cpu_times()
+    error: str | None = None
+    try:
+        yield fields
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        wall = perf_counter() - wall
+        cpu_end = process.cpu_times()
+        record = {
+            "stage": name,
+            "pid": os.getpid(),
+            "started": started,
+            "wall": wall,
+            "cpu": cpu_end.user + cpu_end.system - cpu.user - cpu.system,
+            "children_cpu": cpu_end.children_user
+            + cpu_end.children_system
+            - cpu.children_user
+            - cpu.children_system,
+            "peak_rss": sampler.stop(),
+            **fields,
+        }
+        if error is not None:
+            record["error"] = error
+        # a single write of a line in append mode does not interleave with
+        # the records of other processes
+        with open(report, "a", encoding="utf-8") as out:
+            out.write(json.dumps(record, default=str) + "\n")
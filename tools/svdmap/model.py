@@ -1,15 +1,23 @@
 """Memory map model."""
 
+from bisect import bisect_right
 from dataclasses import dataclass
+from functools import lru_cache
+from itertools import pairwise
 from typing import Literal, Self
 from warnings import warn
 
-from pydantic import BaseModel
+import numpy as np
+import numpy.typing as npt
+from pydantic import BaseModel, Field
+from . import wordsets
 from .serstor.abstract import ExtendedSerializable, NativeSerializable
 
 
 class Address:
-    """Address class."""
+    """Address class. Addresses are never modified in place."""
+
+    __slots__ = ("bits",)
 
     bits: int
 
@@ -32,13 +40,12 @@ class Address:
 
     @classmethod
     def unserialize(cls, data: NativeSerializable) -> Self:
-        """Unserialize the address."""
+        """Unserialize the address. Recurring addresses share one instance."""
 
         if not isinstance(data, str):
             raise TypeError("Expected str.")
 
-        byte_off, bit_off = data.split(":")
-        return cls(int(byte_off, 16), int(bit_off))
+        return _parse_address(cls, data)
 
     def __add__(self, other: "Address") -> "Address":
         """Add two addresses."""
@@ -46,7 +53,7 @@ class Address:
 
     def __sub__(self, other: "Address") -> "Address":
         """Subtract two addresses."""
-        return self + (-other)
+        return Address(0, self.bits - other.bits)
 
     def __neg__(self) -> "Address":
         """Negate an address."""
@@ -54,27 +61,32 @@ class Address:
 
     def __lt__(self, other: "Address") -> bool:
         """Compare two addresses."""
-        return self.byte_offset < other.byte_offset or (
-            self.byte_offset == other.byte_offset and self.bit_offset < other.bit_offset
-        )
+        return self.bits < other.bits
 
     def __eq__(self, other: object) -> bool:
         """Compare two addresses."""
 
+        if isinstance(other, Address):
+            return self.bits == other.bits
+
         if other == 0:
             return self.bits == 0
 
-        if not isinstance(other, Address):
-            return NotImplemented
-
-        return self.bits == other.bits
+        return NotImplemented
 
     def __repr__(self) -> str:
         """Return a string representation of the address."""
         return f"{self.byte_offset:08X}:{self.bit_offset}"
 
 
-@dataclass
+@lru_cache(maxsize=1 << 16)
+def _parse_address[A: Address](cls: type[A], data: str) -> A:
+    """Parse a serialized address."""
+    byte_off, bit_off = data.split(":")
+    return cls(int(byte_off, 16), int(bit_off))
+
+
+@dataclass(slots=True)
 class AddressSpan:
     """Address span class ."""
 
@@ -94,7 +106,7 @@ class AddressSpan:
     @property
     def last_bit(self) -> Address:
         """Return the last bit address."""
-        return self.start + Address(0, self.size.bits - 1)
+        return Address(0, self.start.bits + self.size.bits - 1)
 
     def serialize(self) -> NativeSerializable:
         """Serialize the address span."""
@@ -117,15 +129,17 @@ class AddressSpan:
 
     def __irshift__(self, val: int) -> Self:
         """Shift the beginning of the address right, reducing size."""
-        self.start += Address(0, val)
-        self.size -= Address(0, val)
+        self.start = Address(0, self.start.bits + val)
+        self.size = Address(0, self.size.bits - val)
         return self
 
     def __and__(self, other: "AddressSpan") -> bool:
         """Check if two spans overlap."""
+        start = self.start.bits
+        other_start = other.start.bits
         return (
-            self.start < other.start + other.size
-            and other.start < self.start + self.size
+            start < other_start + other.size.bits
+            and other_start < start + self.size.bits
         )
 
     def __ior__(self, other: "AddressSpan") -> Self:
@@ -135,7 +149,7 @@ class AddressSpan:
         return self
 
 
-@dataclass
+@dataclass(slots=True)
 class Value:
     """Register class ."""
 
@@ -215,9 +229,14 @@ class MemoryMap(ExtendedSerializable):
     read_values: list[Value]
     written_values: list[Value]
 
+    # per list attribute, the list and its length when it was last known
+    # whether its values are sorted and disjoint
+    _ordered: dict[str, tuple[list[Value], int, bool]]
+
     def __init__(self) -> None:
         self.read_values = []
         self.written_values = []
+        self._ordered = {}
 
     @property
     def conflicts(self) -> int:
@@ -254,48 +273,124 @@ class MemoryMap(ExtendedSerializable):
 
         return new_map
 
-    def add_read(self, other: Value) -> Self:
-        """Add a readable register to the memory map."""
+    def _is_ordered(self, attribute: str) -> bool:
+        """
+        Check whether the values of a list attribute are known to be sorted
+        and disjoint, verifying it if the list changed behind our back.
+        """
+        values: list[Value] = getattr(self, attribute)
+        known = self._ordered.get(attribute)
+        if known is not None and known[0] is values and known[1] == len(values):
+            return known[2]
+        ordered = all(v.location.size.bits >= 0 for v in values) and all(
+            a.location.end.bits <= b.location.start.bits for a, b in pairwise(values)
+        )
+        self._ordered[attribute] = (values, len(values), ordered)
+        return ordered
+
+    def _add(self, attribute: str, other: Value) -> None:
+        """
+        Add a value to a sorted list attribute. A value overlapping an existing
+        one is merged into the first such value as a conflict, unless it is
+        the very same register. Sorted and disjoint lists are searched by
+        bisection, others by a linear scan.
+        """
+        values: list[Value] = getattr(self, attribute)
+        ordered = self._is_ordered(attribute)
+        if ordered:
+            # only the neighbours of the insertion point can overlap
+            i = bisect_right(values, other.location.start.bits, key=_start)
+            overlapping = [j for j in (i - 1, i) if 0 <= j < len(values)]
+        else:
+            i = len(values)
+            overlapping = list(range(len(values)))
 
-        for i, v in enumerate(self.read_values):
+        for j in overlapping:
+            v = values[j]
             if v.location & other.location:
                 v.hits += 1
                 if v.location == other.location:
                     if v.reset_value == other.reset_value:
-                        return self
+                        return
                 warn(f"Conflicting registers at {v.location}.")
                 v.location |= other.location
                 v.conflict = True
-                return self
+                # the grown value may now overlap its neighbours, and is
+                # possibly shared with the other list
+                self._ordered.clear()
+                return
             if v.location.start > other.location.start:
-                self.read_values.insert(i, other)
-                return self
-        self.read_values.append(other)
+                i = j
+                break
+
+        values.insert(i, other)
+        if ordered:
+            ordered = other.location.size.bits >= 0 and all(
+                a.location.end.bits <= b.location.start.bits
+                for a, b in pairwise(values[max(i - 1, 0) : i + 2])
+            )
+        self._ordered[attribute] = (values, len(values), ordered)
+
+    def add_read(self, other: Value) -> Self:
+        """Add a readable register to the memory map."""
+        self._add("read_values", other)
         return self
 
     def add_written(self, other: Value) -> Self:
         """Add a writeable register to the memory map."""
-
-        for i, v in enumerate(self.written_values):
-            if v.location & other.location:
-                v.hits += 1
-                if v.location == other.location:
-                    if v.reset_value == other.reset_value:
-                        return self
-                warn(f"Conflicting registers at {v.location}.")
-                v.location |= other.location
-                v.conflict = True
-                return self
-            if v.location.start > other.location.start:
-                self.written_values.insert(i, other)
-                return self
-        self.written_values.append(other)
+        self._add("written_values", other)
         return self
 
 
+def _start(value: Value) -> int:
+    """Bisection key of values."""
+    return value.location.start.bits
+
+
 class Shadow(BaseModel):
-    """Shadow of a memory map. Only keeps track of readable words."""
+    """
+    Shadow of a memory map. Only keeps track of readable and writeable words.
+    Aliases name further devices with the very same shadow, they are left out
+    of the JSON of shadows without any.
+    """
 
     name: str
     read: set[int]
     write: set[int]
+    aliases: list[str] = Field(default=[], exclude_if=lambda aliases: not aliases)
+
+    def to_bytes(self) -> bytes:
+        """Serialize into a compact word set frame."""
+        meta: dict[str, NativeSerializable] = {"name": self.name}
+        if self.aliases:
+            meta["aliases"] = list(self.aliases)
+        return wordsets.encode([self.read, self.write], meta)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Self:
+        """Unserialize from a word set frame."""
+        name, aliases, read, write = decode_shadow(data)
+        # the frame guarantees well formed words, skip validating them again
+        return cls.model_construct(
+            name=name,
+            read=set(read.tolist()),
+            write=set(write.tolist()),
+            aliases=aliases,
+        )
+
+
+def decode_shadow(
+    data: bytes,
+) -> tuple[str, list[str], npt.NDArray[np.uint32], npt.NDArray[np.uint32]]:
+    """
+    Decode the name, aliases and sorted read and write word arrays of a
+    shadow's word set frame, without building sets of the words.
+    """
+    meta, (read, write) = wordsets.decode(data)
+    if not isinstance(meta, dict):
+        raise TypeError("Expected dict")
+    name = meta["name"]
+    aliases = meta.get("aliases", [])
+    if not isinstance(name, str) or not isinstance(aliases, list):
+        raise TypeError("Expected str name and list of aliases")
+    return name, [str(alias) for alias in aliases], read, write
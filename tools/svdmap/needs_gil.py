@@ -1,16 +1,20 @@
 """SVD ingestion that requires the GIL."""
 
+import os
+from contextlib import closing
 from logging import critical
 from pathlib import Path
+from time import monotonic
+from warnings import WarningMessage
 
 from .serstor import Storage
 
+from .instrumentation import stage
+
 from .model import Address, AddressSpan, MemoryMap, Value
-from .parallelization import Result
+from .parallelization import Failure, Result, isolated_map
 
 try:
-    from concurrent.futures import ProcessPoolExecutor, as_completed
-
     from svdsuite import Process
     from svdsuite.model import AccessType, Device
 
@@ -66,15 +70,32 @@ def ingest_file(input_file: Path) -> Result[MemoryMap]:
     @Result.contained
     def build_map(input_file: Path) -> MemoryMap:
         """Build the memory map from the input file."""
-        process = Process.from_svd_file(str(input_file))
-        device = process.get_processed_device()
-        return build_memory_map(device)
+        with stage("ingest_file", file=input_file):
+            process = Process.from_svd_file(str(input_file))
+            device = process.get_processed_device()
+            return build_memory_map(device)
 
     return build_map(input_file)
 
 
-def ingest(input_dir: Path, out: Path, timeout: int | None = None) -> None:
-    """Ingest a directory of SVD files."""
+@stage("ingest")
+def ingest(
+    input_dir: Path,
+    out: Path,
+    timeout: int | None = None,
+    file_timeout: float | None = 300,
+    jobs: int | None = None,
+    max_tasks_per_child: int | None = 50,
+    retries: int = 1,
+) -> None:
+    """
+    Ingest a directory of SVD files. A file taking longer than file_timeout
+    seconds, or crashing its worker, is retried up to retries times after all
+    other files. Files failing every attempt are quarantined: stored as failed
+    results, so later runs skip them. Every outcome is committed as it arrives,
+    so an interrupted run loses none. Workers are recycled after
+    max_tasks_per_child files.
+    """
 
     if not input_dir.exists():
         raise FileNotFoundError(f"Input directory {input_dir} does not exist.")
@@ -88,15 +109,56 @@ def ingest(input_dir: Path, out: Path, timeout: int | None = None) -> None:
     if len(all_svds) != len(svds):
         print(f"Skipping {len(all_svds) - len(svds)} cached SVDs.")
 
+    deadline = None if timeout is None else monotonic() + timeout
     completed = 0
     errors = 0
     with_warnings = 0
-    with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(ingest_file, svd) for svd in svds]
-        try:
-            for future in as_completed(futures, timeout=timeout):
+    quarantined = 0
+    # failures of earlier attempts per file
+    failures: dict[Path, list[str]] = {}
+    attempt = sorted(svds)
+    for attempts in range(1, retries + 2):
+        retry: list[Path] = []
+        finished = 0
+        # forked like the executor used to, as __main__ is not import safe
+        outcomes = isolated_map(
+            ingest_file,
+            attempt,
+            jobs or os.cpu_count() or 1,
+            start_method="fork",
+            timeout=file_timeout,
+            max_tasks_per_child=max_tasks_per_child,
+            # also bounds the wait for stalled workers
+            deadline=deadline,
+        )
+        with closing(outcomes):
+            for svd, outcome in outcomes:
+                finished += 1
+                if isinstance(outcome, Failure):
+                    failures.setdefault(svd, []).append(outcome.reason)
+                    if attempts <= retries:
+                        retry.append(svd)
+                        continue
+                    quarantined += 1
+                    result: Result[MemoryMap] = Result(
+                        (svd,),
+                        {},
+                        None,
+                        Exception(
+                            f"Quarantined after {attempts} "
+                            f"attempt{'s' if attempts > 1 else ''}: "
+                            + " ".join(failures[svd])
+                        ),
+                        [],
+                    )
+                else:
+                    result = outcome
+                    result.warnings += [
+                        WarningMessage(f"Attempt failed: {reason}", Warning, "", 0)
+                        for reason in failures.get(svd, [])
+                    ]
+
                 completed += 1
-                result = future.result()
                 if not result.success:
                     errors += 1
                 elif result.warnings:
@@ -109,19 +171,22 @@ def ingest(input_dir: Path, out: Path, timeout: int | None = None) -> None:
                     f"{errors} failed ({errors / completed * 100:04.1f}%).",
                     end="\r",
                 )
-                svd = result.args[0]
-                assert isinstance(svd, Path)
+                # committed right away, so an interrupted run resumes from here
                 storage[str(svd)] = result
-        except TimeoutError:
-            print()
+        # the map only stops early at the deadline
+        timed_out = finished < len(attempt)
+        print()
+        if timed_out:
             print(f"Timeout after {timeout} seconds.")
-            executor.shutdown(wait=False, cancel_futures=True)
-        else:
-            print()
+            break
+        if not retry:
+            break
+        print(f"Retrying {len(retry)} files.")
+        attempt = retry
 
     print("Finalizing...")
     storage.export_tar()
     print(
-        f"Completed {completed} files with {errors} errors. {len(svds) - completed} "
-        "timed out."
+        f"Completed {completed} files with {errors} errors, {quarantined} of them "
+        f"quarantined. {len(svds) - completed} timed out."
     )
@@ -0,0 +1,265 @@
+"""Precompiled, memory-mappable knowledge base packs."""
+
+import mmap
+import os
+import struct
+import tarfile
+from contextlib import AbstractContextManager
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from types import TracebackType
+from typing import cast
+
+import numpy as np
+import numpy.typing as npt
+
+from .instrumentation import stage
+from . import wordsets
+from .model import Shadow, decode_shadow
+from .ranking import InvertedIndex, ShadowIndex, WordArray
+from .serstor import Storage
+
+PACK_SUFFIX = ".kbpack"
+PACK_MAGIC = b"SVDPACK\0"
+PACK_VERSION = 2
+
+# magic, version, number of sections
+_HEADER = struct.Struct("<8sII")
+# byte offset and byte length of a section
+_SECTION = struct.Struct("<QQ")
+
+# Sections of a pack in file order. Each is a little endian array, aligned to
+# 8 bytes. Offsets index into the array following them, CSR style.
+_SECTIONS: list[tuple[str, np.dtype[np.generic]]] = [
+    ("name_offsets", np.dtype("<i8")),
+    ("name_bytes", np.dtype("u1")),
+    ("name_rows", np.dtype("<i4")),
+    ("read_offsets", np.dtype("<i8")),
+    ("read_words", np.dtype("<u4")),
+    ("write_offsets", np.dtype("<i8")),
+    ("write_words", np.dtype("<u4")),
+    ("read_keys", np.dtype("<u4")),
+    ("read_postings", np.dtype("<i8")),
+    ("read_rows", np.dtype("<i4")),
+    ("write_keys", np.dtype("<u4")),
+    ("write_postings", np.dtype("<i8")),
+    ("write_rows", np.dtype("<i4")),
+]
+
+
+def _align(offset: int) -> int:
+    """Round offset up to the next multiple of 8."""
+    return (offset + 7) & ~7
+
+
+def pack_path(prefix: Path) -> Path:
+    """Return the pack file belonging to a storage prefix or tarball."""
+    if prefix.name.endswith(".tar.gz"):
+        prefix = prefix.with_suffix("").with_suffix("")
+    return prefix.with_suffix(PACK_SUFFIX)
+
+
+def dump_pack(index: ShadowIndex) -> bytes:
+    """Serialize a shadow index into a pack."""
+
+    encoded = [name.encode() for name in index.names]
+    name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+    arrays: dict[str, npt.NDArray[np.generic]] = {
+        "name_offsets": name_offsets,
+        "name_bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "name_rows": index.name_rows,
+        "read_offsets": index.read_offsets,
+        "read_words": index.read_words,
+        "write_offsets": index.write_offsets,
+        "write_words": index.write_words,
+        "read_keys": index.read_index.keys,
+        "read_postings": index.read_index.offsets,
+        "read_rows": index.read_index.rows,
+        "write_keys": index.write_index.keys,
+        "write_postings": index.write_index.offsets,
+        "write_rows": index.write_index.rows,
+    }
+
+    chunks: list[bytes] = []
+    table: list[bytes] = []
+    offset = _align(_HEADER.size + _SECTION.size * len(_SECTIONS))
+    for name, dtype in _SECTIONS:
+        data = np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+        table.append(_SECTION.pack(offset, len(data)))
+        chunks.append(data + bytes(_align(len(data)) - len(data)))
+        offset += _align(len(data))
+
+    header = _HEADER.pack(PACK_MAGIC, PACK_VERSION, len(_SECTIONS)) + b"".join(table)
+    return header + bytes(_align(len(header)) - len(header)) + b"".join(chunks)
+
+
+def load_pack(buffer: bytes | mmap.mmap | memoryview) -> ShadowIndex:
+    """
+    Create a shadow index backed by the arrays of a pack in buffer.
+
+    The arrays are views into buffer, nothing but the names is copied.
+    """
+
+    magic, version, count = _HEADER.unpack_from(buffer)
+    if magic != PACK_MAGIC:
+        raise ValueError("Not a knowledge base pack.")
+    if version != PACK_VERSION or count != len(_SECTIONS):
+        raise ValueError(
+            f"Unsupported knowledge base pack version {version}. Recompile it."
+        )
+
+    arrays: dict[str, npt.NDArray[np.generic]] = {}
+    for i, (name, dtype) in enumerate(_SECTIONS):
+        offset, length = _SECTION.unpack_from(buffer, _HEADER.size + i * _SECTION.size)
+        arrays[name] = np.frombuffer(
+            buffer, dtype=dtype, count=length // dtype.itemsize, offset=offset
+        )
+
+    def section[S: np.generic](name: str, scalar: type[S]) -> npt.NDArray[S]:
+        """The array of a section, typed with its scalar type."""
+        array = arrays[name]
+        assert array.dtype.type is scalar
+        return cast(npt.NDArray[S], array)
+
+    name_offsets = arrays["name_offsets"].tolist()
+    name_bytes = arrays["name_bytes"].tobytes()
+    names = [
+        name_bytes[start:end].decode()
+        for start, end in zip(name_offsets[:-1], name_offsets[1:])
+    ]
+
+    return ShadowIndex(
+        names,
+        section("name_rows", np.int32),
+        section("read_offsets", np.int64),
+        section("read_words", np.uint32),
+        section("write_offsets", np.int64),
+        section("write_words", np.uint32),
+        InvertedIndex(
+            section("read_keys", np.uint32),
+            section("read_postings", np.int64),
+            section("read_rows", np.int32),
+        ),
+        InvertedIndex(
+            section("write_keys", np.uint32),
+            section("write_postings", np.int64),
+            section("write_rows", np.int32),
+        ),
+    )
+
+
+def open_pack(path: Path) -> ShadowIndex:
+    """Memory-map a pack file and create a shadow index backed by it."""
+    with path.open("rb") as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return load_pack(mapped)
+
+
+def _word_arrays(raw: str | bytes) -> tuple[str, list[str], WordArray, WordArray]:
+    """Name, aliases and word arrays of a stored shadow in either format."""
+    if wordsets.is_frame(raw):
+        assert isinstance(raw, bytes)
+        return decode_shadow(raw)
+    shadow = Shadow.model_validate_json(raw)
+    return (
+        shadow.name,
+        shadow.aliases,
+        wordsets.pack_words(shadow.read),
+        wordsets.pack_words(shadow.write),
+    )
+
+
+def _read_tar(path: Path) -> ShadowIndex:
+    """Index the shadow maps of a tarball without going through a storage."""
+    with tarfile.open(path, "r:gz") as tar:
+        shadows: list[tuple[str, list[str], WordArray, WordArray]] = []
+        for member in tar:
+            file = tar.extractfile(member)
+            assert file is not None
+            shadows.append(_word_arrays(file.read()))
+    return ShadowIndex.from_word_arrays(shadows)
+
+
+class SharedPack(AbstractContextManager["SharedPack"]):
+    """
+    Pack of a shadow index placed in shared memory, for processes to attach to
+    without copying. The shared memory is released on exit.
+    """
+
+    memory: SharedMemory
+
+    def __init__(self, index: ShadowIndex) -> None:
+        data = dump_pack(index)
+        self.memory = SharedMemory(create=True, size=len(data))
+        # the buffer is only None once the memory is closed
+        assert self.memory.buf is not None
+        self.memory.buf[: len(data)] = data
+
+    @property
+    def name(self) -> str:
+        """Name to attach to the shared memory by."""
+        return self.memory.name
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.memory.close()
+        self.memory.unlink()
+
+
+def attach_pack(name: str) -> tuple[SharedMemory, ShadowIndex]:
+    """
+    Attach to a shared pack. The index is backed by the returned shared memory,
+    which must be kept open as long as the index is used.
+    """
+    try:
+        # the creator is responsible for unlinking, do not track it here
+        memory = SharedMemory(name=name, track=False)
+    except TypeError:  # track was introduced in Python 3.13
+        memory = SharedMemory(name=name)
+    assert memory.buf is not None
+    return memory, load_pack(memory.buf)
+
+
+def load_knowledge_base(path: Path) -> ShadowIndex:
+    """Load a knowledge base from either a pack or a shadow map storage."""
+    if path.suffix == PACK_SUFFIX:
+        return open_pack(path)
+    cache = pack_path(path).with_suffix(".cache")
+    if (
+        path.name.endswith(".tar.gz")
+        and cache.exists()
+        and cache.stat().st_mtime < path.stat().st_mtime
+    ):
+        # the storage would serve the outdated cache of a replaced tarball
+        return _read_tar(path)
+    with Storage(path) as storage:
+        return ShadowIndex.from_word_arrays(
+            _word_arrays(raw) for _, raw in storage.iter_raw()
+        )
+
+
+@stage("compile_kb")
+def compile_kb(prefix: Path, out: Path | None = None) -> None:
+    """Compile a shadow map storage into a pack."""
+    if out is None:
+        out = pack_path(prefix)
+    index = load_knowledge_base(prefix)
+    data = dump_pack(index)
+    # processes mapping the old pack keep its inode, rewriting it in place
+    # would pull the pages from under them
+    file = NamedTemporaryFile(dir=out.parent, prefix=out.name, delete=False)
+    try:
+        with file:
+            os.fchmod(file.fileno(), 0o644)
+            file.write(data)
+        os.replace(file.name, out)
+    except BaseException:
+        Path(file.name).unlink(missing_ok=True)
+        raise
+    print(f"Packed {len(index)} shadow maps ({index.n_rows} distinct) into {out}.")
@@ -3,10 +3,14 @@
 from __future__ import annotations
 
 import json
-from collections.abc import Callable, Mapping, Sequence
+import multiprocessing
+from collections.abc import Callable, Generator, Iterable, Mapping, Sequence
 from dataclasses import dataclass
-from time import sleep
-from typing import Self, TypedDict
+from multiprocessing.connection import Connection, wait
+from multiprocessing.context import BaseContext
+from multiprocessing.process import BaseProcess
+from time import monotonic, sleep
+from typing import Self, TypedDict, cast
 from warnings import WarningMessage, catch_warnings, warn
 
 import psutil
@@ -19,6 +23,11 @@ from .serstor.abstract import (
 )
 
 
+# Version 1 stored the returned value as a JSON string and had no version key.
+# Version 2 nests it natively, so reading a result decodes JSON only once.
+RESULT_VERSION = 2
+
+
 @dataclass
 class Result[T: Serializable](ExtendedSerializable):
     """Parallelization-friendly result container."""
@@ -28,9 +37,10 @@ class Result[T: Serializable](ExtendedSerializable):
         Serializable version of Result. Keep updated with serialize().
         """
 
+        version: int
         args: list[str]
         kwargs: dict[str, str]
-        returned: str
+        returned: NativeSerializable
         error: str | None
         warnings: list[str]
 
@@ -63,14 +73,16 @@ class Result[T: Serializable](ExtendedSerializable):
 
     def _serialize(self) -> Serialized:
         """Return a serializable version of the result."""
+        returned: NativeSerializable
         if isinstance(self.returned, ExtendedSerializable):
-            returned = json.dumps(self.returned.serialize())
+            returned = self.returned.serialize()
         elif isinstance(self.returned, BaseModel):
-            returned = self.returned.model_dump_json()
+            returned = self.returned.model_dump(mode="json")
         else:
-            returned = json.dumps(self.returned)
+            returned = self.returned
 
         return {
+            "version": RESULT_VERSION,
             "args": [str(a) for a in self.args],
             "kwargs": {k: str(v) for k, v in self.kwargs.items()},
             "returned": returned,
@@ -85,6 +97,40 @@ class Result[T: Serializable](ExtendedSerializable):
         assert is_native_serializable(serialized)
         return serialized  # pyright: ignore
 
+    @staticmethod
+    def peek(data: NativeSerializable) -> tuple[NativeSerializable, str | None]:
+        """
+        Return the serialized returned value and the error message of a
+        serialized result of any version, without decoding anything else.
+        """
+
+        if not isinstance(data, dict):
+            raise TypeError("Expected dict")
+
+        returned = data["returned"]
+        match data.get("version", 1):
+            case 1:
+                if not isinstance(returned, str):
+                    raise TypeError("Expected str")
+                returned = json.loads(returned)
+            case 2:
+                pass
+            case version:
+                raise ValueError(f"Unsupported result version {version}.")
+
+        match data["error"]:
+            case None:
+                error = None
+            case "None":
+                warn("Incorrectly serialized error message. Use newer tarball.")
+                error = None
+            case str(error):
+                pass
+            case _:
+                raise TypeError("Expected str or None")
+
+        return returned, error
+
     @classmethod
     def unserialize(cls, data: NativeSerializable, hint: type[T] | None = None) -> Self:
         """
@@ -95,8 +141,8 @@ class Result[T: Serializable](ExtendedSerializable):
         if hint is None:
             raise ValueError("Type hint required for unserialization.")
 
-        if not isinstance(data, dict):
-            raise TypeError("Expected dict")
+        loaded_json, error = cls.peek(data)
+        assert isinstance(data, dict)
 
         args = data["args"]
         if not isinstance(args, list):
@@ -106,12 +152,7 @@ class Result[T: Serializable](ExtendedSerializable):
         if not isinstance(kwargs, dict):
             raise TypeError("Expected dict")
 
-        returned_str = data["returned"]
-        if not isinstance(returned_str, str):
-            raise TypeError("Expected str")
-
         returned: "T|None"
-        loaded_json = json.loads(returned_str)
         if loaded_json is None:
             returned = None
         elif issubclass(hint, ExtendedSerializable):
@@ -119,16 +160,8 @@ class Result[T: Serializable](ExtendedSerializable):
         elif issubclass(hint, BaseModel):
             returned = hint.model_validate(loaded_json)
         else:
-            returned = loaded_json
-
-        match data["error"]:
-            case None:
-                error = None
-            case "None":
-                warn("Incorrectly serialized error message. Use newer tarball.")
-                error = None
-            case _:
-                error = Exception(data["error"])
+            # hint is a native type itself
+            returned = cast(T, loaded_json)
 
         raw_warnings = data["warnings"]
         if not isinstance(raw_warnings, list):
@@ -139,7 +172,189 @@ class Result[T: Serializable](ExtendedSerializable):
                 raise TypeError("Expected str")
             warnings.append(WarningMessage(warning, Warning, "", 0))
 
-        return cls(args, kwargs, returned, error, warnings)
+        return cls(
+            args,
+            kwargs,
+            returned,
+            None if error is None else Exception(error),
+            warnings,
+        )
+
+
+@dataclass
+class Failure:
+    """Reason an item could not be processed by an isolated worker."""
+
+    reason: str
+
+
+def _isolated_worker[T, R](
+    conn: Connection,
+    func: Callable[[T], R],
+    initializer: Callable[..., object] | None,
+    initargs: tuple[object, ...],
+) -> None:
+    """Process items received over conn until told to stop."""
+    if initializer is not None:
+        initializer(*initargs)
+    while (task := conn.recv()) is not None:
+        (item,) = task
+        try:
+            conn.send((True, func(item)))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            conn.send((False, f"{type(e).__name__}: {e}"))
+
+
+class _Worker[T]:
+    """Worker process together with the item it is processing."""
+
+    process: BaseProcess
+    conn: Connection
+    item: T | None
+    # monotonic time the item was handed over
+    submitted: float
+    # number of items handed over
+    tasks: int
+
+    def __init__(
+        self,
+        context: BaseContext,
+        func: Callable[[T], object],
+        initializer: Callable[..., object] | None,
+        initargs: tuple[object, ...],
+    ) -> None:
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(  # type: ignore[attr-defined]
+            target=_isolated_worker,
+            args=(child_conn, func, initializer, initargs),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.item = None
+        self.submitted = monotonic()
+        self.tasks = 0
+
+    def submit(self, item: T) -> None:
+        """Hand an item to the worker."""
+        self.item = item
+        self.submitted = monotonic()
+        self.tasks += 1
+        self.conn.send((item,))
+
+    def stop(self) -> None:
+        """Ask the worker to exit and wait for it."""
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+def isolated_map[T, R](
+    func: Callable[[T], R],
+    items: Iterable[T],
+    workers: int,
+    initializer: Callable[..., object] | None = None,
+    initargs: tuple[object, ...] = (),
+    start_method: str = "spawn",
+    timeout: float | None = None,
+    max_tasks_per_child: int | None = None,
+    deadline: float | None = None,
+) -> Generator[tuple[T, R | Failure], None, None]:
+    """
+    Apply func to items in worker processes, yielding results as they arrive.
+
+    Every worker runs initializer once, then processes one item at a time. An
+    exception raised by func, or a worker dying, only fails the item at hand;
+    a dead worker is replaced. Workers are spawned by default, so that state
+    such as a JVM is never inherited. A worker still busy with an item timeout
+    seconds after receiving it, including its own start for a fresh worker, is
+    killed. Workers are replaced after max_tasks_per_child items, so memory
+    they leak is returned. Items are only taken from items when a worker is
+    free. Once the monotonic time deadline passes, busy workers are killed and
+    the remaining items are left unprocessed.
+    """
+
+    context = multiprocessing.get_context(start_method)
+    pending = iter(items)
+    pool: list[_Worker[T]] = []
+
+    def start(item: T) -> None:
+        """Start a worker processing item."""
+        worker = _Worker(context, func, initializer, initargs)
+        pool.append(worker)
+        worker.submit(item)
+
+    try:
+        for item in pending:
+            start(item)
+            if len(pool) == workers:
+                break
+
+        while busy := [w for w in pool if w.item is not None]:
+            if deadline is not None and monotonic() >= deadline:
+                return
+            wait_until = deadline
+            if timeout is not None:
+                first_deadline = min(w.submitted for w in busy) + timeout
+                wait_until = min(first_deadline, wait_until or first_deadline)
+            wait_timeout = None
+            if wait_until is not None:
+                wait_timeout = max(wait_until - monotonic(), 0)
+            ready = wait(
+                [w.conn for w in busy] + [w.process.sentinel for w in busy],
+                wait_timeout,
+            )
+            for worker in busy:
+                item = worker.item
+                assert item is not None
+                timed_out = False
+                if worker.conn in ready:
+                    try:
+                        success, value = worker.conn.recv()
+                    except EOFError:
+                        pass  # died while replying
+                    else:
+                        worker.item = None
+                        yield item, value if success else Failure(value)
+                        if (
+                            max_tasks_per_child is not None
+                            and worker.tasks >= max_tasks_per_child
+                        ):
+                            worker.stop()
+                            pool.remove(worker)
+                            for item in pending:
+                                start(item)
+                                break
+                            continue
+                        for item in pending:
+                            worker.submit(item)
+                            break
+                        continue
+                elif worker.process.sentinel not in ready:
+                    if timeout is None or monotonic() - worker.submitted < timeout:
+                        continue
+                    worker.process.kill()
+                    timed_out = True
+
+                worker.process.join()
+                worker.conn.close()
+                pool.remove(worker)
+                yield item, Failure(
+                    f"Timed out after {timeout} seconds."
+                    if timed_out
+                    else f"Worker died with exit code {worker.process.exitcode}."
+                )
+                for item in pending:
+                    start(item)
+                    break
+    finally:
+        for worker in pool:
+            if worker.item is not None:
+                worker.process.kill()
+            worker.stop()
 
 
 def die() -> None:
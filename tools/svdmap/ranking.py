@@ -0,0 +1,495 @@
+"""Vectorized similarity ranking of shadow maps."""
+
+from collections.abc import Iterable, Iterator, Sequence
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Self
+
+import numpy as np
+import numpy.typing as npt
+
+from .model import Shadow
+from .wordsets import pack_words
+
+type WordArray = npt.NDArray[np.uint32]
+type OffsetArray = npt.NDArray[np.int64]
+
+
+def _concatenate(word_sets: Sequence[WordArray]) -> tuple[OffsetArray, WordArray]:
+    """Concatenate sorted word arrays into CSR offsets and words."""
+    offsets = np.zeros(len(word_sets) + 1, dtype=np.int64)
+    np.cumsum([len(w) for w in word_sets], out=offsets[1:])
+    if not word_sets:
+        return offsets, np.zeros(0, dtype=np.uint32)
+    return offsets, np.concatenate(word_sets).astype(np.uint32, copy=False)
+
+
+def _gather(offsets: OffsetArray, rows: npt.NDArray[np.intp]) -> npt.NDArray[np.intp]:
+    """Positions of all entries in the given CSR rows, concatenated."""
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.zeros(0, dtype=np.intp)
+    # shift a running counter so that every row restarts at its own offset
+    shifts = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return np.arange(total, dtype=np.intp) + shifts
+
+
+@dataclass
+class InvertedIndex:
+    """Posting lists mapping each word address to the rows containing it."""
+
+    keys: WordArray
+    offsets: OffsetArray
+    rows: npt.NDArray[np.int32]
+
+    @classmethod
+    def from_csr(cls, offsets: OffsetArray, words: WordArray) -> Self:
+        """Invert CSR rows of words into posting lists of rows."""
+        rows = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+        order = np.argsort(words, kind="stable")
+        keys, starts = np.unique(words[order], return_index=True)
+        postings = np.zeros(len(keys) + 1, dtype=np.int64)
+        postings[:-1] = starts
+        postings[-1] = len(words)
+        return cls(keys.astype(np.uint32, copy=False), postings, rows[order])
+
+    def lookup(self, query: WordArray) -> npt.NDArray[np.intp]:
+        """Positions in keys of the query words known to the index."""
+        positions = np.searchsorted(self.keys, query)
+        inside = positions < len(self.keys)
+        positions = positions[inside]
+        return positions[self.keys[positions] == query[inside]]
+
+    def hits(self, query: WordArray) -> npt.NDArray[np.int32]:
+        """Rows containing each query word, one entry per shared word."""
+        return self.rows[_gather(self.offsets, self.lookup(query))]
+
+    def idf(self, n_rows: int) -> npt.NDArray[np.float64]:
+        """
+        Smoothed inverse document frequency log((1 + n) / (1 + df)) + 1 of
+        each key, where df is the length of its posting list.
+        """
+        return np.log((1 + n_rows) / (1 + np.diff(self.offsets))) + 1
+
+
+@dataclass
+class Rarity:
+    """Precomputed IDF weights of one access type of a knowledge base."""
+
+    key_weights: npt.NDArray[np.float64]
+    row_weights: npt.NDArray[np.float64]
+    unknown_weight: float
+
+
+METRICS = ("jaccard", "read_jaccard", "write_jaccard", "containment", "idf_jaccard")
+"""
+Similarity metrics of a shadow (R, W) to an access map (r, w):
+
+jaccard: (|R & r| + |W & w|) / (|R | r| + |W | w|)
+read_jaccard: |R & r| / |R | r|
+write_jaccard: |W & w| / |W | w|
+containment: (|R & r| + |W & w|) / (|r| + |w|), the fraction of the access map
+    covered by the shadow
+idf_jaccard: jaccard with every word weighted by its IDF among the shadows
+"""
+
+
+def _ratio(
+    numerator: npt.NDArray[np.number], denominator: npt.NDArray[np.number] | int
+) -> npt.NDArray[np.float64]:
+    """Divide elementwise, yielding 0.0 where the denominator is zero."""
+    denominator = np.broadcast_to(denominator, np.shape(numerator))
+    out = np.zeros(np.shape(numerator), dtype=np.float64)
+    np.divide(numerator, denominator, out=out, where=denominator != 0)
+    return out
+
+
+@dataclass
+class ShadowIndex:
+    """
+    Knowledge base of shadow maps packed into CSR arrays of sorted words.
+
+    Every distinct shadow is stored once as a row. Row i covers
+    read_words[read_offsets[i]:read_offsets[i + 1]] and
+    write_words[write_offsets[i]:write_offsets[i + 1]], and name_rows maps
+    each device name to its row. Inverted indices per access type map each
+    word back to the rows containing it.
+    """
+
+    names: list[str]
+    name_rows: npt.NDArray[np.int32]
+    read_offsets: OffsetArray
+    read_words: WordArray
+    write_offsets: OffsetArray
+    write_words: WordArray
+    read_index: InvertedIndex
+    write_index: InvertedIndex
+
+    @classmethod
+    def from_csr(
+        cls,
+        names: list[str],
+        name_rows: npt.NDArray[np.int32],
+        read: tuple[OffsetArray, WordArray],
+        write: tuple[OffsetArray, WordArray],
+    ) -> Self:
+        """Build the index, including inverted indices, from CSR arrays."""
+        return cls(
+            names,
+            name_rows,
+            *read,
+            *write,
+            InvertedIndex.from_csr(*read),
+            InvertedIndex.from_csr(*write),
+        )
+
+    @classmethod
+    def from_shadows(cls, shadows: Iterable[Shadow]) -> Self:
+        """
+        Pack shadow maps into an index, numbering their names in sorted
+        order, the handle order of storage, whichever shadow lists them.
+
+        Shadows with equal read and write words share one row.
+        """
+        return cls.from_word_arrays(
+            (
+                shadow.name,
+                shadow.aliases,
+                pack_words(shadow.read),
+                pack_words(shadow.write),
+            )
+            for shadow in shadows
+        )
+
+    @classmethod
+    def from_word_arrays(
+        cls, shadows: Iterable[tuple[str, Sequence[str], WordArray, WordArray]]
+    ) -> Self:
+        """
+        Pack shadow maps given as name, aliases and sorted read and write word
+        arrays into an index, see from_shadows().
+        """
+        names: list[str] = []
+        name_rows: list[int] = []
+        rows: dict[tuple[bytes, bytes], int] = {}
+        reads: list[WordArray] = []
+        writes: list[WordArray] = []
+        for shadow_name, aliases, read, write in shadows:
+            row = rows.setdefault((read.tobytes(), write.tobytes()), len(rows))
+            if row == len(reads):
+                reads.append(read)
+                writes.append(write)
+            for name in (shadow_name, *aliases):
+                names.append(name)
+                name_rows.append(row)
+        # ties rank in name id order, which must not depend on aliasing
+        order = sorted(range(len(names)), key=names.__getitem__)
+        return cls.from_csr(
+            [names[i] for i in order],
+            np.array(name_rows, dtype=np.int32)[order],
+            _concatenate(reads),
+            _concatenate(writes),
+        )
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def n_rows(self) -> int:
+        """Number of distinct shadows."""
+        return len(self.read_offsets) - 1
+
+    @cached_property
+    def row_names(self) -> tuple[OffsetArray, npt.NDArray[np.intp]]:
+        """CSR offsets and ascending name ids of the names of each row."""
+        order = np.argsort(self.name_rows, kind="stable")
+        offsets = np.searchsorted(
+            self.name_rows[order], np.arange(self.n_rows + 1)
+        ).astype(np.int64)
+        return offsets, order
+
+    def _rarity(
+        self, index: InvertedIndex, offsets: OffsetArray, words: WordArray
+    ) -> Rarity:
+        """Compute IDF weights of the keys and their sums per row."""
+        key_weights = index.idf(self.n_rows)
+        cumulative = np.zeros(len(words) + 1, dtype=np.float64)
+        np.cumsum(key_weights[np.searchsorted(index.keys, words)], out=cumulative[1:])
+        row_weights = cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+        return Rarity(key_weights, row_weights, float(np.log(1 + self.n_rows) + 1))
+
+    @cached_property
+    def read_rarity(self) -> Rarity:
+        """IDF weights of readable words."""
+        return self._rarity(self.read_index, self.read_offsets, self.read_words)
+
+    @cached_property
+    def write_rarity(self) -> Rarity:
+        """IDF weights of writeable words."""
+        return self._rarity(self.write_index, self.write_offsets, self.write_words)
+
+    @property
+    def read_sizes(self) -> OffsetArray:
+        """Number of readable words per shadow."""
+        return np.diff(self.read_offsets)
+
+    @property
+    def write_sizes(self) -> OffsetArray:
+        """Number of writeable words per shadow."""
+        return np.diff(self.write_offsets)
+
+    def intersections(
+        self, read: Iterable[int], write: Iterable[int]
+    ) -> tuple[npt.NDArray[np.intp], OffsetArray, OffsetArray]:
+        """
+        Count words shared with the given access map.
+
+        Only the posting lists of the access map's words are visited. Returns
+        the ascending candidate rows sharing at least one word, and the read
+        and write intersection sizes for each candidate.
+        """
+        read_rows, read_counts = np.unique(
+            self.read_index.hits(pack_words(read)), return_counts=True
+        )
+        write_rows, write_counts = np.unique(
+            self.write_index.hits(pack_words(write)), return_counts=True
+        )
+        candidates = np.union1d(read_rows, write_rows).astype(np.intp)
+        read_inter = np.zeros(len(candidates), dtype=np.int64)
+        read_inter[np.searchsorted(candidates, read_rows)] = read_counts
+        write_inter = np.zeros(len(candidates), dtype=np.int64)
+        write_inter[np.searchsorted(candidates, write_rows)] = write_counts
+        return candidates, read_inter, write_inter
+
+    def _candidate_jaccard(
+        self, read: set[int], write: set[int]
+    ) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.float64]]:
+        """Jaccard similarity of the candidate rows to the given access map."""
+        candidates, read_inter, write_inter = self.intersections(read, write)
+        union = (
+            self.read_sizes[candidates] + len(read) - read_inter
+            + self.write_sizes[candidates] + len(write) - write_inter
+        )
+        return candidates, (read_inter + write_inter) / union
+
+    def jaccard(self, read: set[int], write: set[int]) -> npt.NDArray[np.float64]:
+        """
+        Jaccard similarity of every distinct shadow to the given access map.
+
+        Read and written words are pooled, i.e. the score is
+        (|R & r| + |W & w|) / (|R | r| + |W | w|), and 0.0 for an empty union.
+        """
+        candidates, candidate_scores = self._candidate_jaccard(read, write)
+        scores = np.zeros(self.n_rows, dtype=np.float64)
+        scores[candidates] = candidate_scores
+        return scores
+
+    def metrics(
+        self, read: set[int], write: set[int], metrics: Sequence[str] = METRICS
+    ) -> dict[str, npt.NDArray[np.float64]]:
+        """
+        Compute the given metrics of every distinct shadow to the access map.
+
+        All metrics derive from the same pass over the posting lists of the
+        access map's words, see METRICS for their definitions.
+        """
+        if unknown := set(metrics) - set(METRICS):
+            raise ValueError(f"Unknown metrics {sorted(unknown)}.")
+
+        query = {"read": pack_words(read), "write": pack_words(write)}
+        sides = {
+            "read": (self.read_index, self.read_sizes, self.read_rarity),
+            "write": (self.write_index, self.write_sizes, self.write_rarity),
+        }
+        inter: dict[str, OffsetArray] = {}
+        union: dict[str, OffsetArray] = {}
+        weighted_inter: dict[str, npt.NDArray[np.float64]] = {}
+        weighted_union: dict[str, npt.NDArray[np.float64]] = {}
+        for side, (index, sizes, rarity) in sides.items():
+            matched = index.lookup(query[side])
+            postings = _gather(index.offsets, matched)
+            rows = index.rows[postings]
+            inter[side] = np.bincount(rows, minlength=self.n_rows).astype(np.int64)
+            union[side] = sizes + len(query[side]) - inter[side]
+            if "idf_jaccard" not in metrics:
+                continue
+            # weights of the posting entries, i.e. of the shared words
+            weights = np.repeat(
+                rarity.key_weights[matched], np.diff(index.offsets)[matched]
+            )
+            # bincount sums weights in float64 already, the stubs do not say so
+            weighted_inter[side] = np.bincount(
+                rows, weights=weights, minlength=self.n_rows
+            ).astype(np.float64, copy=False)
+            query_weight = rarity.key_weights[matched].sum() + rarity.unknown_weight * (
+                len(query[side]) - len(matched)
+            )
+            weighted_union[side] = (
+                rarity.row_weights + query_weight - weighted_inter[side]
+            )
+
+        computed: dict[str, npt.NDArray[np.float64]] = {}
+        for metric in metrics:
+            match metric:
+                case "jaccard":
+                    computed[metric] = _ratio(
+                        inter["read"] + inter["write"], union["read"] + union["write"]
+                    )
+                case "read_jaccard":
+                    computed[metric] = _ratio(inter["read"], union["read"])
+                case "write_jaccard":
+                    computed[metric] = _ratio(inter["write"], union["write"])
+                case "containment":
+                    computed[metric] = _ratio(
+                        inter["read"] + inter["write"], len(read) + len(write)
+                    )
+                case "idf_jaccard":
+                    computed[metric] = _ratio(
+                        weighted_inter["read"] + weighted_inter["write"],
+                        weighted_union["read"] + weighted_union["write"],
+                    )
+        return computed
+
+    def metric_table(
+        self, read: set[int], write: set[int], metrics: Sequence[str] = METRICS
+    ) -> Iterator[tuple[str, list[float]]]:
+        """
+        Yield each device name with its metrics, ordered by the first metric,
+        best first. Ties keep the name order.
+        """
+        columns = self.metrics(read, write, metrics)
+        table = np.stack([columns[metric] for metric in metrics], axis=1)
+        table = table[self.name_rows]
+        order = np.argsort(-table[:, 0], kind="stable")
+        for i, row in zip(order.tolist(), table[order].tolist()):
+            yield self.names[i], row
+
+    def iter_rank(
+        self,
+        read: set[int],
+        write: set[int],
+        top_k: int | None = None,
+        min_score: float | None = None,
+    ) -> Iterator[tuple[str, float]]:
+        """
+        Rank device names by Jaccard similarity of their shadows, best first.
+
+        Each distinct shadow is scored once and its score is given to all of
+        its names. Ties keep the name order, matching a stable sort of the
+        scores. Names sharing no word with the access map score 0.0 and are
+        appended in name order. With top_k, only the k best names are
+        yielded, plus any names tied with the k-th positive score, so the
+        result is a prefix of the full ranking. With min_score, only names
+        scoring at least min_score are yielded. The zero scored tail is
+        generated lazily, cut at k names in total with top_k and dropped
+        entirely with a positive min_score.
+        """
+        candidates, row_scores = self._candidate_jaccard(read, write)
+        return self._rank_rows(candidates, row_scores, top_k, min_score)
+
+    def _rank_rows(
+        self,
+        candidates: npt.NDArray[np.intp],
+        row_scores: npt.NDArray[np.float64],
+        top_k: int | None,
+        min_score: float | None,
+    ) -> Iterator[tuple[str, float]]:
+        """
+        Rank the names of candidate rows by their scores, followed by the
+        names of all other rows with score 0.0, see iter_rank().
+        """
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be positive.")
+
+        offsets, names = self.row_names
+        ids = names[_gather(offsets, candidates)]
+        scores = np.repeat(row_scores, np.diff(offsets)[candidates])
+        rest = np.ones(len(self), dtype=np.bool_)
+        rest[ids] = False
+        if min_score is not None:
+            keep = scores >= min_score
+            ids, scores = ids[keep], scores[keep]
+        if top_k is not None and top_k < len(ids):
+            # nothing below the k-th best score can make it into the result
+            threshold = np.partition(scores, -top_k)[-top_k]
+            keep = scores >= threshold
+            ids, scores = ids[keep], scores[keep]
+        order = np.lexsort((ids, -scores))
+        yield from zip([self.names[i] for i in ids[order]], scores[order].tolist())
+        if min_score is not None and min_score > 0:
+            return
+        tail = np.flatnonzero(rest)
+        if top_k is not None:
+            tail = tail[: max(top_k - len(ids), 0)]
+        for i in tail.tolist():
+            yield self.names[i], 0.0
+
+    def rank(
+        self,
+        read: set[int],
+        write: set[int],
+        top_k: int | None = None,
+        min_score: float | None = None,
+    ) -> list[tuple[str, float]]:
+        """Rank device names as a list, see iter_rank()."""
+        return list(self.iter_rank(read, write, top_k, min_score))
+
+
+class IncrementalRanker:
+    """
+    Jaccard ranking against a shadow index of an access map that arrives in
+    batches. Intersection counts per distinct shadow are updated with every
+    batch, so a provisional ranking is available at any point and equals the
+    ranking of the complete access map once all batches were added.
+    """
+
+    index: ShadowIndex
+    read: set[int]
+    write: set[int]
+    read_inter: OffsetArray
+    write_inter: OffsetArray
+
+    def __init__(self, index: ShadowIndex) -> None:
+        self.index = index
+        self.read = set()
+        self.write = set()
+        self.read_inter = np.zeros(index.n_rows, dtype=np.int64)
+        self.write_inter = np.zeros(index.n_rows, dtype=np.int64)
+
+    def add(self, read: Iterable[int], write: Iterable[int]) -> None:
+        """Add a batch of read and written words of the access map."""
+        new_read = set(read) - self.read
+        new_write = set(write) - self.write
+        self.read |= new_read
+        self.write |= new_write
+        self.read_inter += np.bincount(
+            self.index.read_index.hits(pack_words(new_read)),
+            minlength=self.index.n_rows,
+        )
+        self.write_inter += np.bincount(
+            self.index.write_index.hits(pack_words(new_write)),
+            minlength=self.index.n_rows,
+        )
+
+    def iter_rank(
+        self, top_k: int | None = None, min_score: float | None = None
+    ) -> Iterator[tuple[str, float]]:
+        """Rank device names by the words added so far, see ShadowIndex.iter_rank()."""
+        inter = self.read_inter + self.write_inter
+        candidates = np.flatnonzero(inter)
+        union = (
+            self.index.read_sizes[candidates] + len(self.read)
+            + self.index.write_sizes[candidates] + len(self.write)
+            - inter[candidates]
+        )
+        return self.index._rank_rows(  # pylint: disable=protected-access
+            candidates, inter[candidates] / union, top_k, min_score
+        )
+
+    def rank(
+        self, top_k: int | None = None, min_score: float | None = None
+    ) -> list[tuple[str, float]]:
+        """Rank device names as a list, see iter_rank()."""
+        return list(self.iter_rank(top_k, min_score))
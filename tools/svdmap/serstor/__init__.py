@@ -3,9 +3,13 @@
 import json
 import sqlite3
 import tarfile
-from collections.abc import Iterator, MutableMapping
-from contextlib import AbstractContextManager
+from collections import OrderedDict
+from collections.abc import Iterable, Iterator, MutableMapping
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass
 from io import BytesIO
+from itertools import batched
 from logging import info
 from pathlib import Path
 from types import TracebackType
@@ -13,6 +17,7 @@ from types import TracebackType
 from pydantic import BaseModel
 
 from .abstract import (
+    BinarySerializable,
     ExtendedSerializable,
     NativeSerializable,
     Serializable,
@@ -20,16 +25,95 @@ from .abstract import (
 )
 
 
+# Write-ahead logging lets readers proceed during writes and commits without an
+# fsync of the database, the rest trades durability on power loss for speed.
+_PRAGMAS = (
+    "journal_mode = WAL",
+    "synchronous = NORMAL",
+    "temp_store = MEMORY",
+    "cache_size = -65536",
+)
+
+_UPSERT = (
+    "INSERT INTO storage (handle, data) VALUES (?, ?) "
+    "ON CONFLICT (handle) DO UPDATE SET data = excluded.data"
+)
+
+
+# default budget of the in-memory cache of serialized objects
+DEFAULT_CACHE_BYTES = 64 * 2**20
+
+# rows per validation task of a tarball import
+_VALIDATION_CHUNK = 1000
+
+
+def _is_binary(data: str | bytes) -> bool:
+    """Binary serializations start with a NUL byte, which JSON never does."""
+    return isinstance(data, bytes) and data[:1] == b"\0"
+
+
+def _invalid_json(rows: tuple[tuple[str, str | bytes], ...]) -> list[str]:
+    """Handles of the rows whose data is neither binary nor valid JSON."""
+    invalid: list[str] = []
+    for handle, data in rows:
+        if _is_binary(data):
+            continue
+        try:
+            json.loads(data)
+        except ValueError:
+            invalid.append(handle)
+    return invalid
+
+
+def _serialize(result: Serializable, binary: bool = False) -> str | bytes:
+    """Serialize an object for storage, in binary if preferred and possible."""
+    if isinstance(result, ExtendedSerializable | BaseModel):
+        # native values such as int have to_bytes as well, never use theirs
+        if binary and isinstance(result, BinarySerializable):
+            return result.to_bytes()
+        if isinstance(result, ExtendedSerializable):
+            return json.dumps(result.serialize())
+        return result.model_dump_json()
+    return json.dumps(result)
+
+
+@dataclass
+class CacheStats:
+    """Counters of the in-memory cache of a storage."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+
 class Storage(MutableMapping[str, Serializable], AbstractContextManager["Storage"]):
-    """Storage class for arbitrary serializable objects."""
+    """
+    Storage class for arbitrary serializable objects.
+
+    Recently used serialized objects are kept in memory, up to cache_bytes
+    characters of serialized data, evicting the least recently used first.
+
+    With binary, objects with a binary serialization are stored in it rather
+    than as JSON. Either is read back regardless of this setting.
+    """
 
     prefix: Path
+    cache_bytes: int
+    binary: bool
+    stats: CacheStats
 
-    ramcache: dict[str, str | None]
+    _ramcache: OrderedDict[str, str | bytes]
+    _cached_bytes: int
     _conn: sqlite3.Connection
     _cursor: sqlite3.Cursor
+    _batch_depth: int
 
-    def __init__(self, prefix: Path):
+    def __init__(
+        self,
+        prefix: Path,
+        cache_bytes: int = DEFAULT_CACHE_BYTES,
+        binary: bool = False,
+    ):
         if prefix.name.endswith(".tar.gz"):
             # pathlib does not see ".tar" as part of the suffix
             prefix = prefix.with_suffix("")
@@ -45,32 +129,58 @@ class Storage(MutableMapping[str, Serializable], AbstractContextManager["Storage
                 import_tar_afterwards = True
 
         self._conn = sqlite3.connect(
-            str(self.prefix.with_suffix(".cache")), autocommit=False
+            str(self.prefix.with_suffix(".cache")), autocommit=True
         )
-        self._conn.rollback()
+        # the journal mode cannot be changed within a transaction
+        for pragma in _PRAGMAS:
+            self._conn.execute(f"PRAGMA {pragma}")
+        self._conn.autocommit = False
         self._cursor = self._conn.cursor()
+        self._batch_depth = 0
+        self.cache_bytes = cache_bytes
+        self.binary = binary
+        self.stats = CacheStats()
+        self._ramcache = OrderedDict()
+        self._cached_bytes = 0
         self._cursor.execute(
             "CREATE TABLE IF NOT EXISTS storage (handle TEXT PRIMARY KEY, data BLOB)"
         )
         self._conn.commit()
 
-        self.ramcache = {
-            handle: None
-            for handle, in self._cursor.execute("SELECT handle FROM storage").fetchall()
-        }
-
         if import_tar_afterwards:
             self.import_tar()
 
-    def getraw(self, handle: str) -> str:
+    def _remember(self, handle: str, serialized: str | bytes) -> None:
+        """Cache a serialized object, evicting the least recently used."""
+        self._forget(handle)
+        if len(serialized) > self.cache_bytes:
+            return
+        self._ramcache[handle] = serialized
+        self._cached_bytes += len(serialized)
+        while self._cached_bytes > self.cache_bytes:
+            _, evicted = self._ramcache.popitem(last=False)
+            self._cached_bytes -= len(evicted)
+            self.stats.evictions += 1
+
+    def _forget(self, handle: str) -> None:
+        """Drop a serialized object from the cache."""
+        if (cached := self._ramcache.pop(handle, None)) is not None:
+            self._cached_bytes -= len(cached)
+
+    def getraw(self, handle: str) -> str | bytes:
         """Get stored serialized object."""
-        if (val := self.ramcache[handle]) is not None:
+        if (val := self._ramcache.get(handle)) is not None:
+            self._ramcache.move_to_end(handle)
+            self.stats.hits += 1
             return val
+        self.stats.misses += 1
         result = self._cursor.execute(
             "SELECT data FROM storage WHERE handle = ?", (handle,)
         ).fetchone()
-        assert isinstance(result[0], str)
-        self.ramcache[handle] = result[0]
+        if result is None:
+            raise KeyError(handle)
+        assert isinstance(result[0], str | bytes)
+        self._remember(handle, result[0])
         return result[0]
 
     def get_and_unserialize[T: ExtendedSerializable | BaseModel](
@@ -78,71 +188,156 @@ class Storage(MutableMapping[str, Serializable], AbstractContextManager["Storage
     ) -> T:
         """Get and unserialize stored object."""
         raw = self.getraw(handle)
+        if isinstance(raw, bytes):
+            if not issubclass(typ, BinarySerializable):
+                raise TypeError(f"{typ.__name__} has no binary serialization.")
+            return typ.from_bytes(raw)
         if issubclass(typ, ExtendedSerializable):
             data = json.loads(raw)
             assert is_native_serializable(data)
             return typ.unserialize(data)
         return typ.model_validate_json(raw)
 
+    def iter_raw(self) -> Iterator[tuple[str, str | bytes]]:
+        """
+        Iterate over the handles and serialized objects in handle order, in a
+        single query instead of one per handle.
+        """
+        yield from self._conn.execute(
+            "SELECT handle, data FROM storage ORDER BY handle"
+        )
+
     def export_tar(self) -> None:
         """Write the cached storage into a compressed tarball."""
         with tarfile.open(self.prefix.with_suffix(".tar.gz"), "w:gz") as tar:
-            for handle in self:
-                data = BytesIO(self.getraw(handle).encode())
+            for handle, raw in self.iter_raw():
+                data = BytesIO(raw if isinstance(raw, bytes) else raw.encode())
                 tinfo = tarfile.TarInfo(handle)
                 tinfo.size = len(data.getvalue())
                 tar.addfile(tinfo, data)
 
-    def import_tar(self) -> None:
-        """Read the cached storage from a compressed tarball."""
+    def import_tar(self, validate: bool = False, jobs: int | None = None) -> None:
+        """
+        Read the cached storage from a compressed tarball.
+
+        The members are stored as they are, without parsing them, in a single
+        transaction. With validate, they are checked to be valid JSON in jobs
+        parallel processes while importing, and nothing is imported if any is
+        not.
+        """
         with tarfile.open(self.prefix.with_suffix(".tar.gz"), "r:gz") as tar:
-            for member in tar:
-                handle = member.name
-                file = tar.extractfile(member)
-                assert file is not None
-                self[handle] = json.loads(file.read().decode())
+            rows = self._read_members(tar)
+            with self.batch():
+                if not validate:
+                    self._cursor.executemany(_UPSERT, rows)
+                else:
+                    with ProcessPoolExecutor(jobs) as executor:
+                        checks: list[Future[list[str]]] = []
+
+                        def submitted() -> Iterator[tuple[str, str | bytes]]:
+                            for chunk in batched(rows, _VALIDATION_CHUNK):
+                                checks.append(executor.submit(_invalid_json, chunk))
+                                yield from chunk
+
+                        self._cursor.executemany(_UPSERT, submitted())
+                        invalid = [h for check in checks for h in check.result()]
+                    if invalid:
+                        raise ValueError(
+                            f"{len(invalid)} members of the tarball are not valid "
+                            f"JSON, first {invalid[0]}."
+                        )
+                self._ramcache.clear()
+                self._cached_bytes = 0
+
+    @staticmethod
+    def _read_members(tar: tarfile.TarFile) -> Iterator[tuple[str, str | bytes]]:
+        """Read the handles and serialized objects stored in a tarball."""
+        for member in tar:
+            file = tar.extractfile(member)
+            assert file is not None
+            data = file.read()
+            yield member.name, data if _is_binary(data) else data.decode()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Group the writes within into a single transaction, committed on exit.
+        If an exception escapes, all writes of the batch are rolled back.
+        Batches nest, only the outermost one commits.
+        """
+        self._batch_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self._conn.rollback()
+                self._ramcache.clear()
+                self._cached_bytes = 0
+            raise
+        self._batch_depth -= 1
+        if not self._batch_depth:
+            self._conn.commit()
+
+    def setmany(self, items: Iterable[tuple[str, Serializable]]) -> None:
+        """Store many objects in a single transaction."""
+        with self.batch():
+            rows = [
+                (handle, _serialize(result, self.binary)) for handle, result in items
+            ]
+            self._cursor.executemany(_UPSERT, rows)
+            for handle, _ in rows:
+                self._forget(handle)
 
     def __getitem__(self, handle: str) -> NativeSerializable:
-        item = json.loads(self.getraw(handle))
+        raw = self.getraw(handle)
+        if isinstance(raw, bytes):
+            raise TypeError(f"{handle} is stored in binary, use get_and_unserialize().")
+        item = json.loads(raw)
         assert is_native_serializable(item)
         return item
 
     def __setitem__(self, handle: str, result: Serializable) -> None:
-        if isinstance(result, ExtendedSerializable):
-            serialized = json.dumps(result.serialize())
-        elif isinstance(result, BaseModel):
-            serialized = result.model_dump_json()
-        else:
-            serialized = json.dumps(result)
-
-        if handle in self:
-            self._cursor.execute(
-                "UPDATE storage SET data = ? WHERE handle = ?", (handle, serialized)
-            )
-        else:
-            self._cursor.execute(
-                "INSERT INTO storage (handle, data) VALUES (?, ?)", (handle, serialized)
-            )
-        self._conn.commit()
-        self.ramcache[handle] = serialized
+        serialized = _serialize(result, self.binary)
+        with self.batch():
+            self._cursor.execute(_UPSERT, (handle, serialized))
+            self._remember(handle, serialized)
 
     def __delitem__(self, key: str) -> None:
         if key not in self:
             raise KeyError(key)
-        self._cursor.execute("DELETE FROM storage WHERE handle = ?", (key,))
-        self._conn.commit()
-        del self.ramcache[key]
+        with self.batch():
+            self._cursor.execute("DELETE FROM storage WHERE handle = ?", (key,))
+            self._forget(key)
+
+    def clear(self) -> None:
+        """Remove all stored objects in a single statement."""
+        with self.batch():
+            self._cursor.execute("DELETE FROM storage")
+            self._ramcache.clear()
+            self._cached_bytes = 0
 
     def __iter__(self) -> Iterator[str]:
-        return iter(self.ramcache)
+        # a cursor of its own streams the handles, in the order of their index
+        for (handle,) in self._conn.execute("SELECT handle FROM storage"):
+            yield handle
 
     def __contains__(self, handle: object) -> bool:
         if not isinstance(handle, str):
             return False
-        return handle in self.ramcache
+        if handle in self._ramcache:
+            return True
+        return (
+            self._cursor.execute(
+                "SELECT 1 FROM storage WHERE handle = ?", (handle,)
+            ).fetchone()
+            is not None
+        )
 
     def __len__(self) -> int:
-        return len(self.ramcache)
+        (count,) = self._cursor.execute("SELECT COUNT(*) FROM storage").fetchone()
+        assert isinstance(count, int)
+        return count
 
     def __exit__(
         self,
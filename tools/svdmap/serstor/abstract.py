@@ -48,4 +48,18 @@ class ExtendedSerializable(Protocol):
         """Unserialize the object from a dictionary. Optional hint can be provided."""
 
 
+@runtime_checkable
+class BinarySerializable(Protocol):
+    """A protocol for objects with a compact binary serialization."""
+
+    @abstractmethod
+    def to_bytes(self) -> bytes:
+        """Serialize the object to bytes starting with a NUL byte."""
+
+    @classmethod
+    @abstractmethod
+    def from_bytes(cls, data: bytes) -> Self:
+        """Unserialize the object from bytes."""
+
+
 type Serializable = NativeSerializable | ExtendedSerializable | BaseModel
@@ -0,0 +1,94 @@
+"""Compact binary encoding of sets of word addresses."""
+
+import json
+import struct
+import zlib
+from collections.abc import Iterable, Sequence
+
+import numpy as np
+import numpy.typing as npt
+
+from .serstor.abstract import NativeSerializable
+
+# A frame starts with a NUL byte, so it is never mistaken for JSON text.
+MAGIC = b"\0SVDW"
+VERSION = 1
+# frame flag: the body is zlib compressed
+COMPRESSED = 0x1
+
+# magic, version, flags
+_HEADER = struct.Struct("<5sBB")
+_LENGTH = struct.Struct("<I")
+
+
+def is_frame(data: str | bytes) -> bool:
+    """Check whether stored data is a binary frame rather than JSON."""
+    return isinstance(data, bytes) and data.startswith(MAGIC)
+
+
+def pack_words(words: Iterable[int]) -> npt.NDArray[np.uint32]:
+    """Pack a set of word addresses into a sorted uint32 array."""
+    if not isinstance(words, set | frozenset):
+        words = set(words)
+    packed = np.fromiter(words, dtype=np.int64, count=len(words))
+    packed.sort()
+    if packed.size and (packed[0] < 0 or packed[-1] > 0xFFFF_FFFF):
+        raise ValueError("Word address out of 32 bit range.")
+    return packed.astype(np.uint32)
+
+
+def _deltas(words: Iterable[int]) -> bytes:
+    """Sorted words as little endian uint32 differences to their predecessor."""
+    return np.diff(pack_words(words), prepend=0).astype("<u4").tobytes()
+
+
+def encode(
+    word_sets: Sequence[Iterable[int]],
+    meta: NativeSerializable = None,
+    compress: bool = True,
+) -> bytes:
+    """
+    Encode word sets and JSON metadata into a frame. Each set is stored as
+    its count followed by the delta encoded sorted words, which compress
+    well as most registers are a word apart.
+    """
+    meta_json = json.dumps(meta).encode()
+    parts = [_LENGTH.pack(len(meta_json)), meta_json, _LENGTH.pack(len(word_sets))]
+    for words in word_sets:
+        deltas = _deltas(words)
+        parts += [_LENGTH.pack(len(deltas) // 4), deltas]
+    body = b"".join(parts)
+    flags = 0
+    if compress:
+        body = zlib.compress(body)
+        flags |= COMPRESSED
+    return _HEADER.pack(MAGIC, VERSION, flags) + body
+
+
+def decode(
+    frame: bytes,
+) -> tuple[NativeSerializable, list[npt.NDArray[np.uint32]]]:
+    """Decode a frame into its metadata and sorted word arrays."""
+    magic, version, flags = _HEADER.unpack_from(frame)
+    if magic != MAGIC:
+        raise ValueError("Not a word set frame.")
+    if version != VERSION:
+        raise ValueError(f"Unsupported word set frame version {version}.")
+    body = frame[_HEADER.size :]
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+
+    (length,) = _LENGTH.unpack_from(body)
+    offset = _LENGTH.size + length
+    meta = json.loads(body[_LENGTH.size : offset])
+    (count,) = _LENGTH.unpack_from(body, offset)
+    offset += _LENGTH.size
+    word_sets: list[npt.NDArray[np.uint32]] = []
+    for _ in range(count):
+        (size,) = _LENGTH.unpack_from(body, offset)
+        offset += _LENGTH.size
+        deltas = np.frombuffer(body, dtype="<u4", count=size, offset=offset)
+        # uint32 arithmetic wraps exactly like the deltas were computed
+        word_sets.append(np.cumsum(deltas, dtype=np.uint32))
+        offset += 4 * size
+    return meta, word_sets